@@ -0,0 +1,328 @@
+'''JSON / CSV data API, serving the same series that are shown in the graphs
+
+Takes the same query string that Model.to_query_str produces (ie, the one in
+the Save/Share url), plus an optional format=json|csv, and returns the output of
+Model.make_dataset - without creating a bokeh document.
+'''
+
+import collections
+import hashlib
+import json
+import threading
+
+import attr
+import pandas
+import tornado.ioloop
+import tornado.web
+
+from typing import Hashable, Optional, Tuple
+
+from . import datamod
+from . import entities
+from . import memory
+from .entities import registry
+from .main import DEFAULT_INITIAL_ENTITIES, DisplayEntities, Model, \
+    dataset_executor
+
+
+CACHE_SIZE = 256
+
+FORMATS = {
+    'json': 'application/json',
+    'csv': 'text/csv; charset=UTF-8',
+}
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class CachedResponse(object):
+    data_version: Hashable
+    etag: str
+    body: bytes
+
+
+class ResponseCache(object):
+    '''Bounded LRU of rendered responses, keyed by canonical query + format
+
+    Entries remember the data version they were computed from, and are ignored
+    once the underlying data has been refreshed.
+    '''
+
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Tuple[str, str],
+            data_version: Hashable) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.data_version != data_version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Tuple[str, str], data_version: Hashable,
+            body: bytes) -> CachedResponse:
+        digest = hashlib.sha1(repr((key, data_version)).encode('utf-8'))
+        entry = CachedResponse(data_version, '"{}"'.format(digest.hexdigest()),
+                               body)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+
+response_cache = ResponseCache()
+
+
+def check_entities_known(model: Model, arguments):
+    '''Raises ValueError if the query names an entity that isn't in the data
+
+    Every entity a Model holds is interned in the registry, for the life of the
+    process - so the query's are only looked up, and unknown ones rejected,
+    rather than letting anonymous requests grow the registry without bound.
+    '''
+    for key, entity_type in DisplayEntities.QUERY_KEYS.items():
+        raw_entities = arguments.get(key)
+        if not raw_entities:
+            continue
+        cache_item = model.data_items.get(entity_type)
+        if cache_item is not None:
+            # loading the data registers every entity in it
+            cache_item.refresh()
+        for raw in raw_entities:
+            entity = entity_type.deserialize(raw.decode('utf-8'))
+            if registry.lookup(entity) is None:
+                raise ValueError('unknown {}: {}'.format(entity_type.__name__,
+                                                         entity))
+
+
+def model_from_query(arguments) -> Model:
+    '''Builds a Model from parsed query arguments (str -> list of bytes)
+
+    Mirrors Controller.start - if there's no query at all, the default
+    entities are used.  May refresh (and so download) data, so is run in
+    dataset_executor.
+    '''
+    model = Model()
+    if not arguments:
+        for entity in DEFAULT_INITIAL_ENTITIES:
+            model.entities.add(entity)
+    else:
+        check_entities_known(model, arguments)
+        model.set_from_query_dict(arguments)
+    return model
+
+
+def _x_values(x: pandas.Series) -> list:
+    if pandas.api.types.is_datetime64_any_dtype(x):
+        return x.dt.strftime('%Y-%m-%d').tolist()
+    return x.tolist()
+
+
+def _y_values(y: pandas.Series) -> list:
+    # json has no NaN
+    return [None if val != val else val for val in y.tolist()]
+
+
+def render_json(model: Model, dataset) -> bytes:
+    series = []
+    for entity, data in dataset:
+        series.append({
+            'type': type(entity).__name__,
+            'entity': entity.serialize(),
+            'label': str(entity),
+            'x': _x_values(data.x),
+            'y': _y_values(data.y),
+        })
+    result = {'query': model.to_query_str(), 'series': series}
+    return json.dumps(result, separators=(',', ':')).encode('utf-8')
+
+
+def render_csv(model: Model, dataset) -> bytes:
+    del model
+    frames = []
+    for entity, data in dataset:
+        frames.append(pandas.DataFrame({
+            'type': type(entity).__name__,
+            'entity': entity.serialize(),
+            'x': _x_values(data.x),
+            'y': data.y.values,
+        }))
+    if frames:
+        combined = pandas.concat(frames, ignore_index=True)
+    else:
+        combined = pandas.DataFrame(columns=['type', 'entity', 'x', 'y'])
+    return combined.to_csv(index=False).encode('utf-8')
+
+
+RENDERERS = {
+    'json': render_json,
+    'csv': render_csv,
+}
+
+
+def data_response(model: Model, output_format: str) -> CachedResponse:
+    '''Returns the (possibly cached) response for the model's dataset
+
+    May refresh (and so download) data, so is run in dataset_executor.
+    '''
+    key = (model.to_query_str(), output_format)
+    data_version = model.data_version()
+    entry = response_cache.get(key, data_version)
+    if entry is None:
+        body = RENDERERS[output_format](model, model.make_dataset())
+        entry = response_cache.put(key, data_version, body)
+    return entry
+
+
+class DataHandler(tornado.web.RequestHandler):
+    async def get(self):
+        arguments = dict(self.request.arguments)
+        output_format = arguments.pop('format', [b'json'])[-1].decode('utf-8')
+        if output_format not in FORMATS:
+            raise tornado.web.HTTPError(
+                400, 'unknown format: {!r}'.format(output_format))
+
+        # off the io loop, so a cache miss doesn't hold up every session
+        io_loop = tornado.ioloop.IOLoop.current()
+        try:
+            model = await io_loop.run_in_executor(
+                dataset_executor, model_from_query, arguments)
+        except (AssertionError, AttributeError, KeyError, TypeError,
+                ValueError) as err:
+            raise tornado.web.HTTPError(400, 'bad query: {}'.format(err))
+
+        entry = await io_loop.run_in_executor(
+            dataset_executor, data_response, model, output_format)
+
+        self.set_header('Content-Type', FORMATS[output_format])
+        self.set_header('ETag', entry.etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.write(entry.body)
+
+
+ENTITY_TYPES = {x.__name__: x for x in entities.ENTITY_TYPES}
+
+
+def render_cross_section(model: Model, entity_type, values) -> bytes:
+    result = {
+        'query': model.to_query_str(),
+        'type': entity_type.__name__,
+        'date': None,
+        'entities': [],
+        'values': [],
+    }
+    if values is not None:
+        if values.name is not None:
+            result['date'] = values.name.strftime('%Y-%m-%d')
+        result['entities'] = [registry.entity(x).serialize()
+                              for x in values.index.tolist()]
+        result['values'] = _y_values(values)
+    return json.dumps(result, separators=(',', ':')).encode('utf-8')
+
+
+def cross_section_response(model: Model, entity_type,
+                           date: Optional[pandas.Timestamp]) -> CachedResponse:
+    '''Like data_response, for CrossSectionHandler'''
+    key = ('{}&type={}&date={}'.format(model.to_query_str(),
+                                      entity_type.__name__, date),
+           'cross_section')
+    # only depends on the one type's data, not the query's entities
+    cache_item = model.data_items.get(entity_type)
+    data_version = None
+    if cache_item is not None:
+        cache_item.refresh()
+        data_version = cache_item.version
+    entry = response_cache.get(key, data_version)
+    if entry is None:
+        body = render_cross_section(
+            model, entity_type, model.cross_section(entity_type, date))
+        entry = response_cache.put(key, data_version, body)
+    return entry
+
+
+class CrossSectionHandler(tornado.web.RequestHandler):
+    '''Every entity of one type's value of the graphed statistic, on one date
+
+    Takes the same options as /api/data, plus type=Country|Province|State|County
+    (default County) and date=YYYY-MM-DD (default: the latest).  Only json is
+    supported.
+    '''
+
+    async def get(self):
+        arguments = dict(self.request.arguments)
+        type_name = arguments.pop('type', [b'County'])[-1].decode('utf-8')
+        date = arguments.pop('date', [b''])[-1].decode('utf-8') or None
+        if type_name not in ENTITY_TYPES:
+            raise tornado.web.HTTPError(
+                400, 'unknown type: {!r}'.format(type_name))
+        io_loop = tornado.ioloop.IOLoop.current()
+        try:
+            if date is not None:
+                date = pandas.Timestamp(date)
+            model = await io_loop.run_in_executor(
+                dataset_executor, model_from_query, arguments)
+        except (AssertionError, AttributeError, KeyError, TypeError,
+                ValueError) as err:
+            raise tornado.web.HTTPError(400, 'bad query: {}'.format(err))
+
+        entry = await io_loop.run_in_executor(
+            dataset_executor, cross_section_response, model,
+            ENTITY_TYPES[type_name], date)
+
+        self.set_header('Content-Type', FORMATS['json'])
+        self.set_header('ETag', entry.etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.write(entry.body)
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    '''Reports each cache item's metadata - never triggers a fetch'''
+
+    def get(self):
+        items = []
+        for key, item in datamod.data_cache.items():
+            metadata = item.metadata
+            items.append({
+                'key': repr(key),
+                'loaded': item.is_loaded(),
+                'stale': item.is_stale(),
+                'metadata': None if metadata is None else metadata.to_json(),
+            })
+        self.set_header('Content-Type', FORMATS['json'])
+        self.write(json.dumps({'items': items}, separators=(',', ':')))
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    '''Reports memory use - per cache item, per live session, and in total
+
+    See memory.py.  Like /api/health, never triggers a fetch.
+    '''
+
+    def get(self):
+        self.set_header('Content-Type', FORMATS['json'])
+        self.write(json.dumps(memory.stats(), separators=(',', ':')))
+
+
+def url_patterns(prefix=''):
+    '''Tornado handler patterns, for bokeh Server's extra_patterns'''
+    return [
+        (prefix + '/api/data', DataHandler),
+        (prefix + '/api/cross_section', CrossSectionHandler),
+        (prefix + '/api/health', HealthHandler),
+        (prefix + '/api/stats', StatsHandler),
+    ]
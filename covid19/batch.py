@@ -0,0 +1,148 @@
+'''Renders graphs for saved query strings to standalone files, without a server
+
+Usage:
+    python -m covid19.batch [--format html|json] [--out-dir DIR] [--jobs N]
+                            QUERY [QUERY ...]
+
+Each QUERY is a query string, as in the Save/Share url (a full url also works -
+everything up to the "?" is ignored).  Use "-" to read queries from stdin, one
+per line.  Output files are named by their position in the list: 000.html,
+001.html, etc.
+
+Queries are rendered in parallel, in a pool of worker processes - each worker
+loads the data the queries use once, and then reuses it for every query it
+renders.  That data is only downloaded once, by the parent process, which
+records it for the workers to replay (see retrievers.FIXTURE_MODE_ENV_VAR).
+'''
+
+import argparse
+import concurrent.futures
+import json
+import os
+import shutil
+import sys
+import tempfile
+import urllib.parse
+
+import bokeh.embed
+import bokeh.resources
+
+from . import api
+from . import retrievers
+from .main import View
+
+FORMATS = {
+    'html': '.html',
+    'json': '.json',
+}
+
+
+def parse_query(query):
+    '''Returns the query as Model.set_from_query_dict wants it - like the
+    arguments of a tornado request (str -> list of bytes)'''
+    if '?' in query:
+        query = query.split('?', 1)[1]
+    parsed = urllib.parse.parse_qs(query, keep_blank_values=True)
+    return {key: [x.encode('utf-8') for x in val]
+            for key, val in parsed.items()}
+
+
+def render(query, output_format='html'):
+    '''Returns the graph for the given query, as a standalone html page, or a
+    bokeh json item (for bokeh.embed.embed_item)'''
+    model = api.model_from_query(parse_query(query))
+    view = View(None, model)
+    plot = view.make_plot(model.make_dataset(apply_display_options=False))
+    view.set_updated_text(
+        'Updated: {:%Y-%m-%d %H:%M} UTC'.format(model.last_update_time()))
+    title = view.plot_title(model.options['population_adjustment'])
+    if output_format == 'html':
+        return bokeh.embed.file_html(plot, bokeh.resources.CDN, title)
+    elif output_format == 'json':
+        return json.dumps(bokeh.embed.json_item(plot))
+    raise ValueError(output_format)
+
+
+def _load_query_data(queries):
+    '''Fetches the data the queries use up front, so it's done once per
+    process, rather than by whichever query happens to need it first
+
+    Bad queries are skipped - they're reported when rendered.
+    '''
+    for query in queries:
+        try:
+            api.model_from_query(parse_query(query)).data_version()
+        except Exception:
+            pass
+
+
+def _record_query_data(queries, fixture_dir):
+    '''Downloads the data the queries use, saving the payloads to
+    fixture_dir, then has this process (and so the workers it starts) replay
+    them from there, instead of each worker downloading them again'''
+    os.environ[retrievers.FIXTURE_MODE_ENV_VAR] = 'record'
+    os.environ[retrievers.FIXTURE_DIR_ENV_VAR] = fixture_dir
+    _load_query_data(queries)
+    os.environ[retrievers.FIXTURE_MODE_ENV_VAR] = 'replay'
+
+
+def _render_to_file(query, output_format, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(render(query, output_format))
+    return path
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('queries', nargs='+', metavar='QUERY')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='html')
+    parser.add_argument('--out-dir', default='.')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    args = parser.parse_args(argv)
+
+    queries = []
+    for query in args.queries:
+        if query == '-':
+            queries.extend(line.strip() for line in sys.stdin if line.strip())
+        else:
+            queries.append(query)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    num_jobs = max(1, min(args.jobs or 1, len(queries)))
+    failed = 0
+    fixture_dir = None
+    if not os.environ.get(retrievers.FIXTURE_MODE_ENV_VAR):
+        # if fixtures are already being recorded / replayed, leave them be
+        fixture_dir = tempfile.mkdtemp(prefix='covid19_batch_')
+    try:
+        if fixture_dir is not None:
+            _record_query_data(queries, fixture_dir)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=num_jobs, initializer=_load_query_data,
+                initargs=(queries,)) as executor:
+            futures = {}
+            for i, query in enumerate(queries):
+                path = os.path.join(args.out_dir,
+                                    '{:03d}{}'.format(i, FORMATS[args.format]))
+                future = executor.submit(_render_to_file, query, args.format,
+                                         path)
+                futures[future] = query
+            for future in concurrent.futures.as_completed(futures):
+                query = futures[future]
+                try:
+                    print('{} <- {}'.format(future.result(), query))
+                except Exception as err:
+                    failed += 1
+                    print('FAILED: {}: {!r}'.format(query, err),
+                          file=sys.stderr)
+    finally:
+        if fixture_dir is not None:
+            os.environ.pop(retrievers.FIXTURE_MODE_ENV_VAR, None)
+            os.environ.pop(retrievers.FIXTURE_DIR_ENV_VAR, None)
+            shutil.rmtree(fixture_dir, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
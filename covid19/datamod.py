@@ -1,15 +1,91 @@
 '''Concrete Implementations of DataRetrievers and DataCache'''
 
 import attr
+import numpy
 import pandas
 
-from typing import List, Type
+from typing import List, Optional, Tuple, Type
 
 from . import constants
+from . import entities
+from . import storage
 
-from .entities import Country, County, State
+from .entities import Country, County, Province, State
 from .retrievers import DataSource, DataRetriever, DataCache, DataCacheItem, \
-    EntityDataType, FileCachedRetriever
+    EntityDataType, FileCachedRetriever, IndexedJoin, JoinValidation, \
+    combine_fingerprints, dependency_fingerprint, sum_rows, wide_to_long
+
+# Population joins
+
+# These are used both to drop rows for entities that have no population data
+# (IndexedJoin.restrict), and then to add population to each cache item's
+# entity index (via DataRetriever.entity_joins) - so population is stored once
+# per entity, rather than on every row of the time series
+
+# Counties without population data are dropped
+COUNTY_POP_JOIN = IndexedJoin(left_on='fips', columns=['population'])
+
+# The state data has some territories, for which we don't yet have population
+# data (they're dropped) - but every state with population data should be there
+STATE_POP_JOIN = IndexedJoin(left_on='fips', columns=['population'],
+                             validation=JoinValidation.subset)
+
+# joined on interned entity ids, rather than comparing name strings
+COUNTRY_POP_JOIN = IndexedJoin(
+    left_on=lambda data: entities.registry.frame_ids(Country, data),
+    right_on=lambda pop_data: entities.registry.frame_ids(
+        Country, pop_data[['country']].rename(columns={'country': 'name'})),
+    columns=['population'],
+)
+
+# JHU's country names, where they differ from the UN's (as they are in the UN
+# population data - see UNCountryPopulationRetriever)
+JHU_TO_UN_COUNTRY_NAMES = {
+    'Bolivia': 'Bolivia (Plurinational State of)',
+    'Brunei': 'Brunei Darussalam',
+    'Burma': 'Myanmar',
+    'Congo (Brazzaville)': 'Congo',
+    'Congo (Kinshasa)': 'Democratic Republic of the Congo',
+    "Cote d'Ivoire": "C\u00f4te d'Ivoire",
+    'Iran': 'Iran (Islamic Republic of)',
+    'Korea, North': "Dem. People's Republic of Korea",
+    'Korea, South': 'Republic of Korea',
+    'Laos': "Lao People's Democratic Republic",
+    'Micronesia': 'Micronesia (Fed. States of)',
+    'Moldova': 'Republic of Moldova',
+    'Russia': 'Russian Federation',
+    'Syria': 'Syrian Arab Republic',
+    'Taiwan*': 'China, Taiwan Province of China',
+    'Tanzania': 'United Republic of Tanzania',
+    'US': 'United States',
+    'Venezuela': 'Venezuela (Bolivarian Republic of)',
+    'Vietnam': 'Viet Nam',
+    'West Bank and Gaza': 'State of Palestine',
+}
+
+# JHU "countries" that aren't (cruise ships, the Olympics), or that the UN has
+# no population for - these are dropped
+JHU_NON_COUNTRIES = {
+    'Antarctica',
+    'Diamond Princess',
+    'Kosovo',
+    'MS Zaandam',
+    'Summer Olympics 2020',
+    'Winter Olympics 2022',
+}
+
+# Once JHU's names have been mapped, every country must have a population - so
+# a new mismatch fails the refresh, instead of silently dropping the country
+JHU_COUNTRY_POP_JOIN = attr.evolve(COUNTRY_POP_JOIN,
+                                   validation=JoinValidation.covered)
+
+# provinces are identified by (name, country) - also joined on entity ids
+PROVINCE_POP_JOIN = IndexedJoin(
+    left_on=lambda data: entities.registry.frame_ids(Province, data),
+    right_on=lambda pop_data: entities.registry.frame_ids(Province, pop_data),
+    columns=['population'],
+)
+
 
 @attr.s(auto_attribs=True)
 class UsPopulationRetriever(DataRetriever):
@@ -31,7 +107,7 @@ class UsPopulationRetriever(DataRetriever):
 
     def retrieve(self) -> pandas.DataFrame:
         orig_url = self.source().urls['data']
-        orig_data = pandas.read_csv(orig_url, encoding='IBM850')
+        orig_data = self.read_csv(orig_url, encoding='IBM850')
         trimmed_data = orig_data[(orig_data.SUMLEV == 40)
                                  | (orig_data.SUMLEV == 50)]
         trimmed_data = trimmed_data[[
@@ -50,6 +126,12 @@ class CountyPopulationRetriever(DataRetriever):
     def data_types(cls) -> List[EntityDataType]:
         return [EntityDataType(County, 'population')]
 
+    def payload_urls(self) -> List[str]:
+        return []
+
+    def fingerprint(self) -> Optional[str]:
+        return dependency_fingerprint(self.us_pop_cache_item)
+
     def retrieve(self) -> pandas.DataFrame:
         all_pop_data = self.us_pop_cache_item.get()
         county_pop_data = all_pop_data[all_pop_data.SUMLEV == 50][
@@ -95,6 +177,12 @@ class StatePopulationRetriever(DataRetriever):
     def data_types(cls) -> List[EntityDataType]:
         return [EntityDataType(State, 'population')]
 
+    def payload_urls(self) -> List[str]:
+        return []
+
+    def fingerprint(self) -> Optional[str]:
+        return dependency_fingerprint(self.us_pop_cache_item)
+
     def retrieve(self) -> pandas.DataFrame:
         all_pop_data = self.us_pop_cache_item.get()
 
@@ -129,7 +217,7 @@ class UNCountryPopulationRetriever(DataRetriever):
 
     def retrieve(self) -> pandas.DataFrame:
         orig_url = self.source().urls['data']
-        un_pop_raw_data = pandas.read_csv(orig_url)
+        un_pop_raw_data = self.read_csv(orig_url)
         un_pop_data = un_pop_raw_data[un_pop_raw_data['Time'] == 2019]
         # all data <= 2019 is automatically in "medium" variant - VarID = 2
         drop_columns = ['Variant', 'VarID', 'Time', 'MidPeriod', 'PopMale', 'PopFemale', 'PopDensity']
@@ -169,9 +257,17 @@ class NYTimesCountyDataRetriever(DataRetriever):
             EntityDataType(County, 'cases'),
         ]
 
+    def fingerprint(self) -> Optional[str]:
+        return combine_fingerprints(
+            super().fingerprint(),
+            dependency_fingerprint(self.county_pop_cache_item))
+
+    def entity_joins(self) -> List[Tuple[IndexedJoin, DataCacheItem]]:
+        return [(COUNTY_POP_JOIN, self.county_pop_cache_item)]
+
     def retrieve(self) -> pandas.DataFrame:
         url = self.source().urls['data']
-        counties_raw_data = pandas.read_csv(url, parse_dates=['date'])
+        counties_raw_data = self.read_csv(url, parse_dates=['date'])
 
         #nycity_data = counties_raw_data[counties_raw_data.county == 'New York City'].copy()
         #nycity_data.fips = NYCITY_FIPS
@@ -189,15 +285,11 @@ class NYTimesCountyDataRetriever(DataRetriever):
 
         # Filter to only remaining counties that have population data
         county_pop_data = self.county_pop_cache_item.get()
-        #counties_fips = set(counties_data.fips.unique())
-        #county_pop_fips = set(county_pop_data.index.unique())
-        counties_data = counties_data[counties_data.fips.isin(county_pop_data.index)]
+        counties_data = COUNTY_POP_JOIN.restrict(counties_data, county_pop_data)
 
         counties_states = set(counties_data.state.unique())
         assert len(counties_states - constants.US_STATES) == 0
 
-        counties_data = pandas.merge(counties_data, county_pop_data, left_on='fips', right_on=county_pop_data.index)
-
         return counties_data.rename(columns={'county': 'name'})
 
 
@@ -224,23 +316,27 @@ class NYTimesStateDataRetriever(DataRetriever):
             EntityDataType(State, 'cases'),
         ]
 
+    def fingerprint(self) -> Optional[str]:
+        return combine_fingerprints(
+            super().fingerprint(),
+            dependency_fingerprint(self.state_pop_cache_item))
+
+    def entity_joins(self) -> List[Tuple[IndexedJoin, DataCacheItem]]:
+        return [(STATE_POP_JOIN, self.state_pop_cache_item)]
+
     def retrieve(self) -> pandas.DataFrame:
-        # final columns: name, fips, population, cases, deaths
-        states_raw_data = pandas.read_csv(self.source().urls['data'],
-                                          parse_dates=['date'])
+        # final columns: name, fips, cases, deaths
+        states_raw_data = self.read_csv(self.source().urls['data'],
+                                        parse_dates=['date'])
         states_data = states_raw_data.astype({'fips': int})
 
         state_pop_data = self.state_pop_cache_item.get()
 
-        # the nytimes data has some territories, for which we don't yet have pop data...
-        state_pop_fips = set(state_pop_data.index.unique())
+        # the nytimes data has some territories, for which we don't yet have
+        # pop data... they're dropped by the join
         # state_pop_data has 50 states + DC
-        assert len(state_pop_fips) == 51
-        states_fips = set(states_data.fips.unique())
-        assert state_pop_fips.issubset(states_fips)
-
-        states_data = pandas.merge(states_data, state_pop_data['population'], how='inner',
-                                   left_on='fips', right_on=state_pop_data.index)
+        assert len(state_pop_data) == 51
+        states_data = STATE_POP_JOIN.restrict(states_data, state_pop_data)
 
         # Confirm all states in nytimes data have abbreviations
         states_states = set(states_data.state.unique())
@@ -249,17 +345,12 @@ class NYTimesStateDataRetriever(DataRetriever):
         return states_data.rename(columns={'state': 'name'})
 
 
-# Note: I think this could be genericized to also handle
-# NYTimesCountyDataRetriever / NYTimesStateDataRetriever.  Only thing those
-# do differently is that they also do validation between the pop data + the
-# deaths data, so would need a way to handle that (probably with a parameter,
-# to say no validation / subset validation / exact match validation... as
-# well as parameters to say what fields to join on)
 @attr.s(auto_attribs=True)
 class PopModifiedDeathsRetriever(DataRetriever):
     '''Modifies the raw_retriever to add in popuplation data'''
     raw_retreiver: DataRetriever
     pop_cache_item: DataCacheItem
+    pop_join: IndexedJoin = COUNTRY_POP_JOIN
 
     def source(self) -> DataSource:
         return self.raw_retreiver.source()
@@ -267,25 +358,32 @@ class PopModifiedDeathsRetriever(DataRetriever):
     def data_types(self) -> List[EntityDataType]:
         return self.raw_retreiver.data_types()
 
+    def fingerprint(self) -> Optional[str]:
+        return combine_fingerprints(
+            self.raw_retreiver.fingerprint(),
+            dependency_fingerprint(self.pop_cache_item))
+
+    def discard_payloads(self) -> None:
+        self.raw_retreiver.discard_payloads()
+
+    def entity_joins(self) -> List[Tuple[IndexedJoin, DataCacheItem]]:
+        return [(self.pop_join, self.pop_cache_item)]
+
     def retrieve(self) -> pandas.DataFrame:
         country_deaths_data = self.raw_retreiver.retrieve()
 
         pop_data = self.pop_cache_item.get()
-        country_deaths_data = pandas.merge(country_deaths_data, pop_data[
-            ['country', 'population']], how='inner',
-                                           left_on='name',
-                                           right_on='country')
-        return country_deaths_data
+        return self.pop_join.restrict(country_deaths_data, pop_data)
 
 
 @attr.s(auto_attribs=True)
-class JHUCountryDeathsData(DataRetriever):
+class JHUProvincePopulationRetriever(DataRetriever):
     _source = DataSource(
         id='JHU',
         name="Johns Hopkins University Center for Systems Science and Engineering",
         urls={
             'site': 'https://github.com/CSSEGISandData/COVID-19',
-            'data': 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_deaths_global.csv',
+            'data': 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/UID_ISO_FIPS_LookUp_Table.csv',
         },
     )
 
@@ -294,23 +392,138 @@ class JHUCountryDeathsData(DataRetriever):
 
     @classmethod
     def data_types(cls) -> List[EntityDataType]:
-        return [
-            EntityDataType(Country, 'deaths'),
-            EntityDataType(Country, 'cases'),
-        ]
+        return [EntityDataType(Province, 'population')]
 
     def retrieve(self) -> pandas.DataFrame:
-        country_deaths_raw_data = pandas.read_csv(self.source().urls['data'])
-        country_deaths_data = country_deaths_raw_data.rename(columns={
-            'Country/Region': 'name',
-            'Province/State': 'province',
+        raw_data = self.read_csv(self.source().urls['data'])
+        # The lookup table also has every US state and county - we only want
+        # the provinces of other countries
+        is_province = (raw_data.Province_State.notna()
+                       & raw_data.Admin2.isna()
+                       & (raw_data.Country_Region != 'US')
+                       & raw_data.Population.notna())
+        pop_data = raw_data[is_province].rename(columns={
+            'Province_State': 'name',
+            'Country_Region': 'country',
+            'Population': 'population',
         })
-        # filter out province / state data for now (might want to eventually support this)
-        country_deaths_data = country_deaths_data[country_deaths_data.province.isna()]
-        country_deaths_data = country_deaths_data.drop(['province', 'Lat', 'Long'], axis='columns')
-        country_deaths_data = country_deaths_data.melt(id_vars=['country'], var_name='date', value_name='deaths')
-        country_deaths_data['date'] = pandas.to_datetime(country_deaths_data.date)
-        return country_deaths_data
+        pop_data = pop_data[['name', 'country', 'population']]
+        return pop_data.reset_index(drop=True)
+
+
+@attr.s(auto_attribs=True)
+class JHUGlobalDataRetriever(DataRetriever):
+    '''Base for retrievers of the JHU global time series
+
+    These are wide tables - a row per province (or whole country), and a column
+    per date - which are read directly as 2-D arrays, rather than melted.
+    '''
+    _source = DataSource(
+        id='JHU',
+        name="Johns Hopkins University Center for Systems Science and Engineering",
+        urls={
+            'site': 'https://github.com/CSSEGISandData/COVID-19',
+            'deaths': 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_deaths_global.csv',
+            'cases': 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_global.csv',
+        },
+    )
+    STATS = ('deaths', 'cases')
+
+    def source(self) -> DataSource:
+        return self._source
+
+    def payload_urls(self) -> List[str]:
+        return [self.source().urls[stat] for stat in self.STATS]
+
+    def read_wide(self):
+        '''Returns (keys, dates, {stat: values})
+
+        keys has province and country columns (province is null for rows that
+        are a whole country), and each values array has a row per row of keys,
+        and a column per date.
+        '''
+        keys = dates = None
+        stats = {}
+        for stat in self.STATS:
+            raw_data = self.read_csv(self.source().urls[stat])
+            raw_data = raw_data.rename(columns={
+                'Province/State': 'province',
+                'Country/Region': 'country',
+            })
+            # columns are: province, country, lat, long, then one per date
+            date_columns = raw_data.columns[4:]
+            these_dates = pandas.to_datetime(date_columns, format='%m/%d/%y')
+            values = raw_data[date_columns].to_numpy(dtype=float)
+            these_keys = raw_data[['province', 'country']]
+            if keys is None:
+                keys = these_keys.reset_index(drop=True)
+                dates = these_dates
+            else:
+                # the tables should have the same rows and dates, but the
+                # deaths and cases files aren't always updated together
+                key_index = pandas.MultiIndex.from_frame(keys.fillna(''))
+                rows = key_index.get_indexer(
+                    pandas.MultiIndex.from_frame(these_keys.fillna('')))
+                columns = dates.get_indexer(these_dates)
+                has_row, has_column = rows >= 0, columns >= 0
+                aligned = numpy.full((len(keys), len(dates)), numpy.nan)
+                aligned[numpy.ix_(rows[has_row], columns[has_column])] = \
+                    values[numpy.ix_(has_row, has_column)]
+                values = aligned
+            stats[stat] = values
+        return keys, dates, stats
+
+
+@attr.s(auto_attribs=True)
+class JHUCountryDataRetriever(JHUGlobalDataRetriever):
+    '''Country totals, summed over each country's provinces
+
+    Countries are named as the UN names them (see JHU_TO_UN_COUNTRY_NAMES), so
+    they join to the UN population data.
+    '''
+
+    @classmethod
+    def data_types(cls) -> List[EntityDataType]:
+        return [EntityDataType(Country, stat) for stat in cls.STATS]
+
+    def retrieve(self) -> pandas.DataFrame:
+        keys, dates, stats = self.read_wide()
+        is_country = ~keys.country.isin(JHU_NON_COUNTRIES).values
+        names = keys.country[is_country].replace(JHU_TO_UN_COUNTRY_NAMES)
+        groups, countries = pandas.factorize(names, sort=True)
+        totals = {stat: sum_rows(groups, len(countries), values[is_country])
+                  for stat, values in stats.items()}
+        # final columns: name, date, deaths, cases
+        return wide_to_long(pandas.DataFrame({'name': countries}), dates,
+                            **totals)
+
+
+@attr.s(auto_attribs=True)
+class JHUProvinceDataRetriever(JHUGlobalDataRetriever):
+    province_pop_cache_item: DataCacheItem
+
+    @classmethod
+    def data_types(cls) -> List[EntityDataType]:
+        return [EntityDataType(Province, stat) for stat in cls.STATS]
+
+    def fingerprint(self) -> Optional[str]:
+        return combine_fingerprints(
+            super().fingerprint(),
+            dependency_fingerprint(self.province_pop_cache_item))
+
+    def entity_joins(self) -> List[Tuple[IndexedJoin, DataCacheItem]]:
+        return [(PROVINCE_POP_JOIN, self.province_pop_cache_item)]
+
+    def retrieve(self) -> pandas.DataFrame:
+        keys, dates, stats = self.read_wide()
+        is_province = keys.province.notna().values
+        keys = keys[is_province].rename(columns={'province': 'name'})
+        # final columns: name, country, date, deaths, cases
+        data = wide_to_long(keys[['name', 'country']], dates,
+                            **{stat: values[is_province]
+                               for stat, values in stats.items()})
+        return PROVINCE_POP_JOIN.restrict(data,
+                                          self.province_pop_cache_item.get())
 
 
 @attr.s(auto_attribs=True)
@@ -335,8 +548,8 @@ class OWIDCountryDataRetriever(DataRetriever):
         ]
 
     def retrieve(self) -> pandas.DataFrame:
-        country_raw_data = pandas.read_csv(self.source().urls['data'],
-                                                  parse_dates=['date'])
+        country_raw_data = self.read_csv(self.source().urls['data'],
+                                         parse_dates=['date'])
         country_data = country_raw_data.rename(columns={
             'location': 'name',
             'total_deaths': 'deaths',
@@ -373,17 +586,25 @@ class CovidTrackingStateDataRetriever(DataRetriever):
             # EntityDataType(State, 'ventilator'),
         ]
 
+    def fingerprint(self) -> Optional[str]:
+        return combine_fingerprints(
+            super().fingerprint(),
+            dependency_fingerprint(self.state_pop_cache_item))
+
+    def entity_joins(self) -> List[Tuple[IndexedJoin, DataCacheItem]]:
+        return [(STATE_POP_JOIN, self.state_pop_cache_item)]
+
     def retrieve(self) -> pandas.DataFrame:
         # final columns:
-        #   name, fips, population,
+        #   name, fips,
         #   cases,
         #   deaths,
         #   hospitalizations, hospitalizations:current,
         #   icu, icu:current,
         #   ventilator, ventilator:current
 
-        raw_data = pandas.read_csv(self.source().urls['data'],
-                                                  parse_dates=['date'])
+        raw_data = self.read_csv(self.source().urls['data'],
+                                 parse_dates=['date'])
 
         # start by dropping fields project itself has declared deprecated
         DEPRECATED = [
@@ -438,14 +659,10 @@ class CovidTrackingStateDataRetriever(DataRetriever):
         state_pop_data = self.state_pop_cache_item.get()
 
         # data has some territories, for which we don't yet have pop data...
-        state_pop_fips = set(state_pop_data.index.unique())
+        # they're dropped by the join
         # state_pop_data has 50 states + DC
-        assert len(state_pop_fips) == 51
-        states_fips = set(data.fips.unique())
-        assert state_pop_fips.issubset(states_fips)
-
-        data = pandas.merge(data, state_pop_data['population'], how='inner',
-                            left_on='fips', right_on=state_pop_data.index)
+        assert len(state_pop_data) == 51
+        data = STATE_POP_JOIN.restrict(data, state_pop_data)
 
         # Convert all states to unabbreviated values
         data['name'] = [constants.ABBREV_TO_STATE[x] for x in data.state]
@@ -458,7 +675,7 @@ class CovidTrackingStateDataRetriever(DataRetriever):
         return data
 
 
-data_cache = DataCache()
+data_cache = DataCache(storage.storage_factory_from_environment())
 
 data_cache.add(FileCachedRetriever(
     UsPopulationRetriever(),
@@ -493,11 +710,16 @@ data_cache.add(PopModifiedDeathsRetriever(
     data_cache[Country, 'population', 'UN'],
 ))
 
-# Currently not used - doesn't have data for US, or summed data for Australia,
-# and a few other countries
+# Country data also comes from OWID, which Model.set_data prefers (see
+# main.PREFERRED_SOURCES) - JHU is mostly here for the provinces
+data_cache.add(PopModifiedDeathsRetriever(
+    JHUCountryDataRetriever(),
+    data_cache[Country, 'population', 'UN'],
+    pop_join=JHU_COUNTRY_POP_JOIN,
+))
 
-# data_cache.add(PopModifiedDeathsRetriever(
-#     JHUCountryDeathsData(),
-#     data_cache[Country, 'population', 'UN'],
-# ))
+data_cache.add(JHUProvincePopulationRetriever())
 
+data_cache.add(JHUProvinceDataRetriever(
+    data_cache[Province, 'population', 'JHU'],
+))
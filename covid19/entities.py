@@ -1,6 +1,10 @@
 import attr
 
-# Entities - Country / State / County data types
+# Entities - Country / Province / State / County data types
+
+import numpy
+import pandas
+import threading
 
 from collections import namedtuple
 
@@ -41,29 +45,109 @@ class Entity(object):
         return {field: value for field, value in zip(self._fields, self)}
 
     def filter_dataframe(self, dataframe):
+        if 'entity_id' in dataframe.columns:
+            return dataframe[dataframe.entity_id.values == self.id]
         return filter_dataframe(dataframe, **self.dataframe_conditions())
 
+    @property
+    def id(self):
+        '''Small integer uniquely identifying this entity in this process'''
+        return registry.id(self)
+
 
 class Country(Entity, namedtuple('CountryBase', ['name'])):
     pass
 
+class Province(Entity, namedtuple('ProvinceBase', ['name', 'country'])):
+    '''A province / state of a country other than the US (ie, the states of
+    Australia, or the provinces of Canada)'''
+    pass
+
 class State(Entity, namedtuple('StateBase', ['name'])):
-    def __new__(cls, *args, **kwargs):
+    def __new__(cls, name):
         # force non-abbreviated name
-        self = super().__new__(cls, *args, **kwargs)
-        if self.name in constants.ABBREV_TO_STATE:
-            self = State(constants.ABBREV_TO_STATE[self.name])
-        return self
+        return super().__new__(cls, constants.ABBREV_TO_STATE.get(name, name))
 
 class County(Entity, namedtuple('CountyBase', ['name', 'state'])):
-    def __new__(cls, *args, **kwargs):
+    def __new__(cls, name, state):
         # force abbreviated state name
-        self = super().__new__(cls, *args, **kwargs)
-        if self.state in constants.STATE_TO_ABBREV:
-            self = County(self.name, constants.STATE_TO_ABBREV[self.state])
-        return self
+        return super().__new__(cls, name,
+                               constants.STATE_TO_ABBREV.get(state, state))
 
     def dataframe_conditions(self):
         conditions = super().dataframe_conditions()
         conditions['state'] = constants.ABBREV_TO_STATE[conditions['state']]
         return conditions
+
+
+# in display order
+ENTITY_TYPES = (Country, Province, State, County)
+
+
+class EntityRegistry(object):
+    '''Process-wide table that interns each entity, and gives it an int id
+
+    Ids are handed out in order of first registration, and are stable for the
+    lifetime of the process - but NOT across processes, so never serialize them!
+    '''
+
+    def __init__(self):
+        self._ids = {}
+        self._entities = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entities)
+
+    @staticmethod
+    def _key(entity):
+        # entities are namedtuples, so Country('Georgia') == State('Georgia') -
+        # need to include the type in the key to tell them apart
+        return type(entity), tuple(entity)
+
+    def id(self, entity):
+        key = self._key(entity)
+        try:
+            return self._ids[key]
+        except KeyError:
+            pass
+        with self._lock:
+            # check again, in case another thread registered it meanwhile
+            entity_id = self._ids.get(key)
+            if entity_id is None:
+                entity_id = len(self._entities)
+                self._entities.append(entity)
+                self._ids[key] = entity_id
+            return entity_id
+
+    def lookup(self, entity):
+        '''Returns the entity's id, or None if it's never been registered -
+        unlike id, doesn't register it'''
+        return self._ids.get(self._key(entity))
+
+    def intern(self, entity):
+        '''Returns the canonical instance equal to the given entity'''
+        return self._entities[self.id(entity)]
+
+    def entity(self, entity_id):
+        return self._entities[entity_id]
+
+    def frame_ids(self, entity_type, dataframe):
+        '''Returns an array with the entity id for each row of dataframe
+
+        The dataframe must have a column for each of entity_type's fields; each
+        distinct entity is only constructed (and normalized) once.
+        '''
+        fields = list(entity_type._fields)
+        if len(fields) == 1:
+            codes, uniques = pandas.factorize(dataframe[fields[0]])
+            uniques = [(x,) for x in uniques]
+        else:
+            codes, uniques = pandas.MultiIndex.from_frame(
+                dataframe[fields]).factorize()
+        unique_ids = numpy.array([self.id(entity_type(*x)) for x in uniques],
+                                 dtype=numpy.int32)
+        return unique_ids[codes]
+
+
+registry = EntityRegistry()
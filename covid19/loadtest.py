@@ -0,0 +1,292 @@
+'''Load test - how many simultaneous sessions can one server process handle?
+
+Usage:
+    python -m covid19.loadtest record FIXTURE_DIR
+    python -m covid19.loadtest run FIXTURE_DIR [--sessions 1,5,10,25]
+                                               [--repeat N] [--port PORT]
+
+"record" downloads every data source once, saving the raw payloads to
+FIXTURE_DIR.  "run" starts a server (see server.py) that replays those payloads
+instead of downloading anything, so every run sees the same data.  Then, for
+each session count, it opens that many sessions at once over the bokeh
+websocket protocol (with bokeh.client), and has each one run through a script
+of interactions (see INTERACTIONS).  For each session count, it reports latency
+percentiles for opening a session and for each interaction, along with the
+server's CPU use and RSS.
+
+Linux only - server CPU / RSS are read from /proc.
+'''
+
+import argparse
+import collections
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import bokeh.client
+import bokeh.models
+import numpy
+
+from . import datamod
+from . import memory
+from . import retrievers
+from .main import POP_ADJ_COLUMN_SUFFIXES, DailyCumulativeCurrent, \
+    DateWindow, PopulationAdjustment, XAxisStat, YAxisStat
+from .server import APP_PATH
+
+
+# (widget name, property, value) - each is a property change made in the
+# session's (client side) document, which the server then handles just as if a
+# browser had made it.  Button clicks aren't available through bokeh.client, so
+# entities are only toggled, not added.  Sliders only act on value_throttled
+# (which a browser sets when the slider is released).
+INTERACTIONS = [
+    ('ystat', 'value', YAxisStat.cases.value),
+    ('daily', 'value', DailyCumulativeCurrent.daily.value),
+    ('daily_average_size', 'value_throttled', 14),
+    ('daily_average_size', 'value_throttled', 3),
+    ('xstat', 'value', XAxisStat.date.value),
+    ('date_window', 'value', DateWindow.last90.value),
+    ('pick_state', 'value', 'New York'),
+    ('visible:State:New York', 'active', []),
+    # the new plot leaves out the hidden line, so showing it again adds it
+    # (see Controller.add_lines) - then population adjustment has to cover it
+    ('ystat', 'value', YAxisStat.deaths.value),
+    ('visible:State:New York', 'active', [0]),
+    ('population_adjustment', 'value', PopulationAdjustment.raw.value),
+    ('population_adjustment', 'value', PopulationAdjustment.per_million.value),
+]
+
+PERCENTILES = [50, 90, 99]
+
+SERVER_START_TIMEOUT = 300
+
+# how long to wait for the server to apply the plot update an interaction
+# starts, and how often to check
+UPDATE_TIMEOUT = 60
+UPDATE_POLL_INTERVAL = 0.01
+
+
+################################################################################
+# Server process stats
+
+def process_cpu_seconds(pid):
+    '''Total user + system CPU time used by the process'''
+    with open('/proc/{}/stat'.format(pid)) as f:
+        # the command name (field 2) may have spaces, so split after it
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime, stime are fields 14 and 15
+    ticks = int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+
+################################################################################
+# Sessions
+
+class Results(object):
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def add_latency(self, kind, seconds):
+        with self._lock:
+            self.latencies[kind].append(seconds)
+
+    def add_error(self, error):
+        with self._lock:
+            self.errors.append(error)
+
+
+def wait_for_update(session, updating):
+    '''Waits until the server has applied any pending plot update
+
+    The "Updating..." indicator (see Controller.update_plot) is shown from
+    when an update is requested until its new dataset has been applied.
+    bokeh.client only takes in the server's changes to the document during a
+    round trip, so this polls.
+    '''
+    deadline = time.monotonic() + UPDATE_TIMEOUT
+    while updating.visible:
+        if time.monotonic() > deadline:
+            raise RuntimeError('plot not updated within {}s'
+                               .format(UPDATE_TIMEOUT))
+        time.sleep(UPDATE_POLL_INTERVAL)
+        session.force_roundtrip()
+
+
+def check_display_callbacks(document):
+    '''Raises if switching population adjustment in the browser would miss any
+    of the plot's lines
+
+    The switch is made by a CustomJS callback, which bokeh.client can't run -
+    but its args can be checked against the lines that are there.
+    '''
+    select = document.select_one({'name': 'population_adjustment'})
+    callback, = select.js_property_callbacks['change:value']
+    covered = {x.id for x in callback.args['sources']}
+    raw_suffix = POP_ADJ_COLUMN_SUFFIXES[PopulationAdjustment.raw]
+    for source in document.select({'type': bokeh.models.ColumnDataSource}):
+        is_line = any(name in source.data
+                      for name in ('y' + raw_suffix, 'ys' + raw_suffix))
+        if is_line and source.id not in covered:
+            raise RuntimeError('population adjustment callback is missing a'
+                               ' line source')
+
+
+def run_session(app_url, results, repeat=1):
+    try:
+        start = time.perf_counter()
+        session = bokeh.client.pull_session(url=app_url)
+        results.add_latency('open', time.perf_counter() - start)
+        try:
+            document = session.document
+            updating = document.select_one({'name': 'updating'})
+            for _ in range(repeat):
+                for name, prop, value in INTERACTIONS:
+                    model = document.select_one({'name': name})
+                    if model is None:
+                        continue
+                    start = time.perf_counter()
+                    setattr(model, prop, value)
+                    # the server handles each session's messages in order, so
+                    # once this returns, the change has been handled, and any
+                    # plot update it needs has been requested
+                    session.force_roundtrip()
+                    wait_for_update(session, updating)
+                    results.add_latency(name, time.perf_counter() - start)
+                    check_display_callbacks(document)
+        finally:
+            session.close()
+    except Exception as err:
+        results.add_error(err)
+
+
+def run_sessions(app_url, num_sessions, repeat=1):
+    results = Results()
+    threads = [threading.Thread(target=run_session,
+                                args=(app_url, results, repeat))
+               for _ in range(num_sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+################################################################################
+# Reporting
+
+def format_latencies(kind, latencies):
+    values = numpy.percentile(latencies, PERCENTILES) * 1000
+    return '  {:<24} n={:<5} {}  max={:.0f}ms'.format(
+        kind, len(latencies),
+        '  '.join('p{}={:.0f}ms'.format(p, v)
+                  for p, v in zip(PERCENTILES, values)),
+        max(latencies) * 1000)
+
+
+def report(num_sessions, results, wall_seconds, cpu_seconds, rss_bytes):
+    print('{} session(s): {:.1f}s, server cpu {:.0f}%, server rss {:.0f}MB'
+          .format(num_sessions, wall_seconds,
+                  100 * cpu_seconds / wall_seconds, rss_bytes / 2 ** 20))
+    all_interactions = []
+    for kind, latencies in results.latencies.items():
+        print(format_latencies(kind, latencies))
+        if kind != 'open':
+            all_interactions.extend(latencies)
+    if all_interactions:
+        print(format_latencies('(all interactions)', all_interactions))
+    if results.errors:
+        print('  {} error(s), first: {!r}'.format(len(results.errors),
+                                                 results.errors[0]))
+    sys.stdout.flush()
+
+
+################################################################################
+# Commands
+
+def record(fixture_dir):
+    os.environ[retrievers.FIXTURE_MODE_ENV_VAR] = 'record'
+    os.environ[retrievers.FIXTURE_DIR_ENV_VAR] = fixture_dir
+    for key, item in datamod.data_cache.items():
+        print('recording {!r}'.format(key))
+        item.refresh()
+
+
+def start_server(fixture_dir, port):
+    env = dict(os.environ)
+    env[retrievers.FIXTURE_MODE_ENV_VAR] = 'replay'
+    env[retrievers.FIXTURE_DIR_ENV_VAR] = fixture_dir
+    env['BOKEH_ALLOW_WS_ORIGIN'] = 'localhost:{}'.format(port)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'covid19.server', '--port', str(port)],
+        env=env)
+    health_url = 'http://localhost:{}{}/api/health'.format(port, APP_PATH)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        if server.poll() is not None:
+            raise RuntimeError('server exited with code {}'
+                               .format(server.returncode))
+        try:
+            with urllib.request.urlopen(health_url):
+                return server
+        except OSError:
+            if time.monotonic() > deadline:
+                server.terminate()
+                raise RuntimeError('server did not start within {}s'
+                                   .format(SERVER_START_TIMEOUT))
+            time.sleep(0.5)
+
+
+def run(fixture_dir, session_counts, repeat=1, port=5007):
+    server = start_server(fixture_dir, port)
+    try:
+        app_url = 'http://localhost:{}{}'.format(port, APP_PATH)
+        # the first session loads all the data - don't count that
+        warmup = run_sessions(app_url, 1)
+        if warmup.errors:
+            raise RuntimeError('warm-up session failed: {!r}'
+                               .format(warmup.errors[0]))
+        for num_sessions in session_counts:
+            cpu_start = process_cpu_seconds(server.pid)
+            wall_start = time.perf_counter()
+            results = run_sessions(app_url, num_sessions, repeat=repeat)
+            wall_seconds = time.perf_counter() - wall_start
+            cpu_seconds = process_cpu_seconds(server.pid) - cpu_start
+            report(num_sessions, results, wall_seconds, cpu_seconds,
+                   memory.process_rss_bytes(server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record_parser = subparsers.add_parser(
+        'record', help='download and save the data sources as fixtures')
+    record_parser.add_argument('fixture_dir')
+    run_parser = subparsers.add_parser(
+        'run', help='run the load test against the recorded fixtures')
+    run_parser.add_argument('fixture_dir')
+    run_parser.add_argument('--sessions', default='1,5,10,25',
+                            help='comma-separated session counts to try')
+    run_parser.add_argument('--repeat', type=int, default=1,
+                            help='times each session runs the interactions')
+    run_parser.add_argument('--port', type=int, default=5007)
+    args = parser.parse_args(argv)
+
+    fixture_dir = os.path.abspath(args.fixture_dir)
+    if args.command == 'record':
+        record(fixture_dir)
+    else:
+        session_counts = [int(x) for x in args.sessions.split(',')]
+        run(fixture_dir, session_counts, repeat=args.repeat, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
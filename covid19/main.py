@@ -5,11 +5,20 @@
 # - https://realpython.com/lessons/using-groupfilter-and-cdsview/
 
 from . import datamod
+from . import memory
+from . import profiling
 
 import abc
+import concurrent.futures
+import copy
+import datetime
 import enum
+import functools
 import inspect
+import itertools
+import numpy
 import re
+import threading
 import urllib
 
 import bokeh.application.handlers
@@ -20,8 +29,9 @@ import bokeh.plotting
 from collections import namedtuple
 
 from .constants import KELLY_COLORS
-from .entities import Country, County, Entity, State, filter_dataframe
-from .retrievers import DataCacheKey, EntityDataType
+from .entities import ENTITY_TYPES, Country, County, Entity, Province, \
+    State, filter_dataframe, registry
+from .retrievers import DataCacheKey, EntityDataType, refresh_notifier
 
 
 ################################################################################
@@ -39,6 +49,42 @@ def is_mobile_agent(user_agent):
 
 ################################################################################
 
+# Above this many lines, draw them all with a single multi_line glyph, instead
+# of one renderer (+ ColumnDataSource) per entity
+MULTI_LINE_THRESHOLD = 12
+
+DEFAULT_TOP_COUNT = 10
+
+# Datasets are computed in this many threads, shared by all sessions, so one
+# session's big dataset doesn't hold up every other session's callbacks
+DATASET_WORKERS = 4
+dataset_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=DATASET_WORKERS, thread_name_prefix='make_dataset')
+
+# Plot updates requested within this many milliseconds of each other (ie, while
+# clicking through several visibility checkboxes) are coalesced into one
+PLOT_UPDATE_DELAY_MS = 150
+
+def hex_color(rgb):
+    return '#{:02x}{:02x}{:02x}'.format(*rgb)
+
+
+def daily_rolling_average(values, window):
+    '''Returns the day-to-day changes in values, averaged over the past window
+    days
+
+    Matches values.diff().rolling(window, min_periods=1).mean(), with the first
+    change taken as 0 - but since values is already the running sum of its
+    changes, each window's total is just one subtraction, whatever it's size.
+    '''
+    values = numpy.asarray(values, dtype=float)
+    sums = values - values[0]
+    totals = sums.copy()
+    totals[window:] -= sums[:-window]
+    # at the start of the series, average over only the days we have
+    counts = numpy.minimum(numpy.arange(1, len(values) + 1), window)
+    return totals / counts
+
 DEFAULT_INITIAL_ENTITIES = [
     Country('Italy'),
     State('California'),
@@ -47,6 +93,17 @@ DEFAULT_INITIAL_ENTITIES = [
     County('New York City', 'NY'),
 ]
 
+# initial selections in the Add tab
+DEFAULT_PICK_COUNTRY = 'Spain'
+DEFAULT_PICK_STATE = 'California'
+DEFAULT_PICK_PROVINCE = Province('New South Wales', 'Australia')
+
+# when an entity type's data is available from more than one source, the one to
+# graph
+PREFERRED_SOURCES = {
+    Country: 'OWID',
+}
+
 
 ################################################################################
 # Bokeh application logic
@@ -119,8 +176,36 @@ class PopulationAdjustment(enum.Enum):
     raw = 'raw'
     per_million = 'per million'
 
+@enum.unique
+class DateWindow(enum.Enum):
+    all = 'all dates'
+    last30 = 'last 30 days'
+    last60 = 'last 60 days'
+    last90 = 'last 90 days'
+
+DATE_WINDOW_DAYS = {
+    DateWindow.last30: 30,
+    DateWindow.last60: 60,
+    DateWindow.last90: 90,
+}
+
 Option = namedtuple('Option', ['name', 'default', 'type'])
 
+# Options that only change how already-fetched data is displayed - the plot
+# sources carry everything needed, and these are applied in the browser (via
+# CustomJS), without recomputing anything on the server
+DISPLAY_ONLY_OPTIONS = {'population_adjustment', 'yscale'}
+
+# Options that change the values on the Leaders tab - ystat does too, but it's
+# only re-ranked once the data items have been switched (see ystat_changed)
+LEADERBOARD_OPTIONS = {'daily', 'daily_average_size', 'population_adjustment'}
+
+# which source column holds the y values for each PopulationAdjustment
+POP_ADJ_COLUMN_SUFFIXES = {
+    PopulationAdjustment.raw: '_raw',
+    PopulationAdjustment.per_million: '_per_million',
+}
+
 class Options(QuerySerializeable):
     OPTIONS_LIST = [
         Option('ystat', YAxisStat.deaths, YAxisStat),
@@ -130,7 +215,9 @@ class Options(QuerySerializeable):
                PopulationAdjustment),
         Option('daily', DailyCumulativeCurrent.cumulative,
                DailyCumulativeCurrent),
-        Option('daily_average_size', 7, int)
+        Option('daily_average_size', 7, int),
+        Option('date_window', DateWindow.all, DateWindow),
+        Option('webgl', False, bool),
     ]
 
     OPTIONS = {x.name: x for x in OPTIONS_LIST}
@@ -194,11 +281,24 @@ class Options(QuerySerializeable):
 
 
 class DisplayEntities(QuerySerializeable):
-    def __init__(self, countries=(), states=(), counties=(), visible=None,
-                 hidden=None):
+    # the query key listing the entities of each type
+    QUERY_KEYS = {
+        'countries': Country,
+        'provinces': Province,
+        'states': State,
+        'counties': County,
+    }
+
+    def __init__(self, countries=(), states=(), counties=(), provinces=(),
+                 visible=None, hidden=None):
         self._countries = set(countries)
+        self._provinces = set(provinces)
         self._states = set(states)
         self._counties = set(counties)
+        # membership, visibility, and indices are all tracked by interned
+        # entity id
+        self._ids = {x.id for x in self._countries | self._provinces
+                     | self._states | self._counties}
         self._visible = set()
         self._callbacks = {}
         self._invalidate()
@@ -216,18 +316,15 @@ class DisplayEntities(QuerySerializeable):
         return iter(self.ordered())
 
     def __len__(self):
-        return len(self._countries) + len(self._states) + len(self._counties)
+        return len(self._countries) + len(self._provinces) \
+               + len(self._states) + len(self._counties)
 
     def __getitem__(self, i):
         return self.ordered()[i]
 
     def __contains__(self, item):
-        if isinstance(item, Country):
-            return item in self._countries
-        elif isinstance(item, State):
-            return item in self._states
-        elif isinstance(item, County):
-            return item in self._counties
+        if isinstance(item, Entity):
+            return item.id in self._ids
         return False
 
     def _invalidate(self):
@@ -237,51 +334,58 @@ class DisplayEntities(QuerySerializeable):
 
     def ordered(self):
         if self._ordered is None:
-            self._ordered = sorted(self._countries) + sorted(self._states) \
-                            + sorted(self._counties)
+            self._ordered = sorted(self._countries) \
+                            + sorted(self._provinces) \
+                            + sorted(self._states) + sorted(self._counties)
         return self._ordered
 
     def indices(self):
         if self._indices is None:
             self._indices = {
-                entity: i for i, entity in enumerate(self.ordered())
+                entity.id: i for i, entity in enumerate(self.ordered())
             }
         return self._indices
 
     def index(self, entity):
-        return self.indices()[entity]
+        return self.indices()[entity.id]
 
     def add(self, entity):
         if isinstance(entity, Country):
             self._countries.add(entity)
+        elif isinstance(entity, Province):
+            self._provinces.add(entity)
         elif isinstance(entity, State):
             self._states.add(entity)
         elif isinstance(entity, County):
             self._counties.add(entity)
         else:
-            raise TypeError("must be a Country, State, or County - got: {!r}"
-                            .format(entity))
+            raise TypeError("must be a Country, Province, State, or County - "
+                            "got: {!r}".format(entity))
+        self._ids.add(entity.id)
         self.set_visibility(entity, True)
         self._invalidate()
 
     def remove(self, entity):
         if isinstance(entity, Country):
             self._countries.remove(entity)
+        elif isinstance(entity, Province):
+            self._provinces.remove(entity)
         elif isinstance(entity, State):
             self._states.remove(entity)
         elif isinstance(entity, County):
             self._counties.remove(entity)
         else:
-            raise TypeError("must be a Country, State, or County - got: {!r}"
-                            .format(entity))
+            raise TypeError("must be a Country, Province, State, or County - "
+                            "got: {!r}".format(entity))
+        self._ids.discard(entity.id)
         self.set_visibility(entity, False)
         self._invalidate()
 
     def set_visibility(self, entity, is_visible):
         if is_visible:
-            self._visible.add(entity)
+            self._visible.add(entity.id)
         else:
-            self._visible.discard(entity)
+            self._visible.discard(entity.id)
         self._visible_ordered = None
 
     def set_all_visible(self, visible):
@@ -291,7 +395,7 @@ class DisplayEntities(QuerySerializeable):
         elif not all(isinstance(x, Entity) for x in visible):
             raise ValueError('all inputs must be either Entity objects or '
                              'integer indices')
-        self._visible.update(visible)
+        self._visible.update(x.id for x in visible)
         self._visible_ordered = None
 
     def set_all_hidden(self, hidden):
@@ -302,24 +406,24 @@ class DisplayEntities(QuerySerializeable):
             raise ValueError('all inputs must be either Entity objects or '
                              'integer indices')
         self._visible.clear()
-        self._visible.update(set(self) - set(hidden))
+        self._visible.update(self._ids - {x.id for x in hidden})
         self._visible_ordered = None
 
     def is_visible(self, entity):
-        return entity in self._visible
+        return entity.id in self._visible
 
     def visible(self):
-        return set(self._visible)
+        return {registry.entity(x) for x in self._visible}
 
     def visible_ordered(self):
         if self._visible_ordered is None:
             self._visible_ordered = [x for x in self.ordered()
-                                     if x in self._visible]
+                                     if x.id in self._visible]
         return self._visible_ordered
 
     @classmethod
     def valid_query_keys(cls):
-        return {'countries', 'states', 'counties', 'hidden'}
+        return set(cls.QUERY_KEYS) | {'hidden'}
 
     def _to_query_dict(self):
         # when serializing, we output invisible, instead of visible, since we
@@ -327,11 +431,13 @@ class DisplayEntities(QuerySerializeable):
         result = {}
         if self._countries:
             result['countries'] = sorted(x.serialize() for x in self._countries)
+        if self._provinces:
+            result['provinces'] = sorted(x.serialize() for x in self._provinces)
         if self._states:
             result['states'] = sorted(x.serialize() for x in self._states)
         if self._counties:
             result['counties'] = sorted(x.serialize() for x in self._counties)
-        hidden = [x for x in self if x not in self._visible]
+        hidden = [x for x in self if x.id not in self._visible]
         if hidden:
             # ordering is well defined, so can use indices, which avoids needing
             # to specify the type (Country/State/County) of each entry in
@@ -344,12 +450,14 @@ class DisplayEntities(QuerySerializeable):
         countries = [Country.deserialize(x) for x in raw.get('countries', [])]
         states = [State.deserialize(x) for x in raw.get('states', [])]
         counties = [County.deserialize(x) for x in raw.get('counties', [])]
+        provinces = [Province.deserialize(x)
+                     for x in raw.get('provinces', [])]
         hidden = raw.get('hidden')
         if hidden:
             # we need to convert hidden indices, from str to int
             hidden = [int(x) for x in hidden]
         return cls(countries=countries, states=states, counties=counties,
-                   hidden=hidden)
+                   provinces=provinces, hidden=hidden)
 
 
 class Model(object):
@@ -366,7 +474,7 @@ class Model(object):
     def set_data(self):
         all_keys = datamod.data_cache.keys()
         self.data_items.clear()
-        for entity in (Country, State, County):
+        for entity in ENTITY_TYPES:
             # TODO: make data_cache use hierarchical keying
             stat = self.options['ystat'].name
             desired_datatype = EntityDataType(entity, stat)
@@ -380,60 +488,214 @@ class Model(object):
             elif len(valid_keys) == 1:
                 key = valid_keys[0]
             else:
-                # # right now, hard-code state data to covid_tracking
-                # assert entity == State
-                # key = [x for x in valid_keys
-                #        if x.source_id == 'covid_tracking'][0]
-                raise RuntimeError("more than one source for {}/{} data"
-                                   .format(entity.__name__, stat))
+                preferred = [x for x in valid_keys
+                             if x.source_id == PREFERRED_SOURCES.get(entity)]
+                if len(preferred) != 1:
+                    raise RuntimeError("more than one source for {}/{} data"
+                                       .format(entity.__name__, stat))
+                key = preferred[0]
             self.data_items[entity] = datamod.data_cache[key]
 
+    def snapshot(self):
+        '''Returns a copy of the model, that's safe to read from another
+        thread while this one goes on changing'''
+        snapshot = copy.copy(self)
+        snapshot.entities = copy.deepcopy(self.entities)
+        snapshot.options = copy.deepcopy(self.options)
+        snapshot.data_items = dict(self.data_items)
+        return snapshot
+
     def last_update_time(self):
         return max(item.update_time for item in self.data_items.values())
 
+    def data_version(self, refresh=True):
+        '''Returns a hashable token that changes whenever the data for any of
+        our entities is refreshed
+
+        If refresh is False, stale items aren't refreshed first (which may
+        download) - their current version is used.
+        '''
+        versions = []
+        entity_types = {type(x) for x in self.entities}
+        for entity_type in ENTITY_TYPES:
+            item = self.data_items.get(entity_type)
+            if item is None or entity_type not in entity_types:
+                continue
+            if refresh:
+                # make sure the item is up to date before reading it's version
+                item.refresh()
+            versions.append((entity_type.__name__, item.version))
+        return tuple(versions)
+
     @staticmethod
-    def deaths_per_mill_greater_1(data):
-        return data.deaths / (data.population / 1e6) >= 1.0
+    def deaths_per_mill_greater_1(deaths, population):
+        return deaths / (population / 1e6) >= 1.0
 
-    def graphable_entities(self, entity_type, **conditions):
-        from .entities import filter_dataframe
+    def graphable_index(self, entity_type, **conditions):
+        '''Returns the rows of the entity index for the graphable entities of
+        the given type, or None if there's no data for it'''
         if entity_type not in self.data_items:
-            return []
-        dataframe = self.data_items[entity_type].get()
+            return None
+        # the entity index has one row per entity, with the per-entity max of
+        # each stat - enough to filter on without reading any time series
+        index = self.data_items[entity_type].entity_index()
         extra_conditions = []
         if self.options['xstat'] == XAxisStat.days1DM:
-            extra_conditions.append(self.deaths_per_mill_greater_1(dataframe))
-        dataframe = filter_dataframe(dataframe, *extra_conditions, **conditions)
-        return sorted(dataframe.name.unique())
+            extra_conditions.append(
+                self.deaths_per_mill_greater_1(index.deaths, index.population))
+        return filter_dataframe(index, *extra_conditions, **conditions)
+
+    def graphable_entities(self, entity_type, **conditions):
+        index = self.graphable_index(entity_type, **conditions)
+        if index is None:
+            return []
+        return sorted(index.name.unique())
 
-    def make_dataset(self):
+    def graphable_provinces(self):
+        '''Returns all graphable provinces - as Province objects, since names
+        alone aren't unique across countries'''
+        index = self.graphable_index(Province)
+        if index is None:
+            return []
+        return sorted({Province(name, country)
+                       for name, country in zip(index.name, index.country)})
+
+    def state_counties(self, state):
+        '''Returns all graphable counties in the given state'''
+        return [County(name, state)
+                for name in self.graphable_entities(County, state=state)]
+
+    def stat_column(self):
+        '''The data column for the graphed statistic'''
+        stat_name = self.options['ystat'].name
+        if self.options['daily'] == DailyCumulativeCurrent.current:
+            stat_name += ':current'
+        return stat_name
+
+    def leaderboard(self, entity_type, count, lowest=False):
+        '''Returns [(entity, value)] for the count entities of the given type
+        with the highest (or lowest) most-recent value of the graphed statistic
+        (daily-averaged or population-adjusted, if those options are set)'''
+        if entity_type not in self.data_items:
+            return []
+        per_million = self.options['population_adjustment'] \
+            == PopulationAdjustment.per_million
+        daily_window = None
+        if self.options['daily'] == DailyCumulativeCurrent.daily:
+            daily_window = max(1, self.options['daily_average_size'])
+        # already sorted, once per data refresh
+        ranking = self.data_items[entity_type].ranking(
+            self.stat_column(), per_million, daily_window)
+        if lowest:
+            ranking = ranking.iloc[::-1]
+        return [(registry.entity(entity_id), value)
+                for entity_id, value in ranking.iloc[:count].items()]
+
+    def top_entities(self, entity_type, count):
+        '''Returns the entities of the given type with the highest most-recent
+        value of the graphed statistic (population-adjusted, if that option is
+        set)'''
+        return [entity for entity, _ in self.leaderboard(entity_type, count)]
+
+    def cross_section(self, entity_type, date=None):
+        '''Returns the graphed statistic for every entity of the given type on
+        one date (default: the latest), as a series indexed by entity id
+
+        Daily-averaged or population-adjusted, if those options are set.  The
+        series' name is the date used - see DateEntityMatrix.row.  Returns None
+        if there's no data.
+        '''
+        cache_item = self.data_items.get(entity_type)
+        if cache_item is None:
+            return None
+        matrix = cache_item.date_matrix(self.stat_column())
+        if matrix is None:
+            return None
+        if self.options['daily'] == DailyCumulativeCurrent.daily:
+            values = matrix.daily_row(
+                max(1, self.options['daily_average_size']), date)
+        else:
+            values = matrix.row(date)
+        if self.options['population_adjustment'] \
+                == PopulationAdjustment.per_million:
+            population = cache_item.entity_index().population
+            per_million = values / (population.reindex(values.index) / 1e6)
+            # keep the date name
+            values = per_million.rename(values.name)
+        return values
+
+    def date_window_start(self, cache_item):
+        '''Returns the first date to graph for the date_window option, or None
+        to graph all dates'''
+        days = DATE_WINDOW_DAYS.get(self.options['date_window'])
+        if days is None:
+            return None
+        cache_item.refresh()
+        max_date = cache_item.metadata.max_date
+        if max_date is None:
+            return None
+        return max_date - datetime.timedelta(days=days - 1)
+
+    def make_dataset(self, apply_display_options=True, entities=None):
+        '''Returns a list of (entity, data) pairs, one for each visible entity
+
+        Each data frame has an 'x' column, and the y values both unadjusted
+        ('y_raw') and per million people ('y_per_million'); 'y' is whichever
+        of those the population_adjustment option selects.
+
+        If apply_display_options is False, the rows are not filtered for the
+        yscale option - for consumers that apply it themselves.
+
+        If entities is given, only those are included - ie, to add lines for
+        them to an already-made plot.
+        '''
         to_graph = []
         pop_adj = self.options['population_adjustment']
         xstat = self.options['xstat']
 
-        def get_data_since(data, condition_func):
-            condition = condition_func(data)
+        def get_data_since(data, condition):
             since_data = data[condition].reset_index(drop=True)
             day0 = since_data.date.min()
             since_data['x'] = (since_data.date - day0).apply(lambda x: x.days)
             return since_data
 
-        for entity in self.entities.visible_ordered():
+        stat_name = self.stat_column()
+        warmup = 0
+        if self.options['daily'] == DailyCumulativeCurrent.daily:
+            # the rolling average at the start of the window needs the
+            # previous daily_average_size values
+            warmup = self.options['daily_average_size']
+        # only read the columns we need - with column storage, the other stats
+        # are then never loaded
+        columns = ['date', stat_name]
+        if xstat == XAxisStat.days1DM:
+            columns.append('deaths')
+
+        if entities is None:
+            entities = self.entities.visible_ordered()
+        for entity in entities:
             try:
-                data = self.data_items[type(entity)].get()
+                cache_item = self.data_items[type(entity)]
             except KeyError:
                 continue
-            data = entity.filter_dataframe(data)
+            window_start = self.date_window_start(cache_item)
+            # population is kept per entity, not on every row
+            population = cache_item.entity_value(entity, 'population')
             if xstat == XAxisStat.days1DM:
-                data = get_data_since(data, self.deaths_per_mill_greater_1)
+                # "days since" is measured from the start of the entity's
+                # history, so we need all of it - window afterwards
+                data = cache_item.entity_data(entity, columns=columns)
+                assert len(data) > 0, f"no {entity.__class__.__name__} data for {entity}"
+                data = get_data_since(data, self.deaths_per_mill_greater_1(
+                    data.deaths, population))
             else:
+                data = cache_item.entity_data(entity, start_date=window_start,
+                                              warmup=warmup, column=stat_name,
+                                              columns=columns)
+                if window_start is None:
+                    assert len(data) > 0, f"no {entity.__class__.__name__} data for {entity}"
                 data['x'] = data['date']
-                print(data['x'].dtype)
 
-            assert len(data) > 0, f"no {entity.__class__.__name__} data for {entity}"
-            stat_name = self.options['ystat'].name
-            if self.options['daily'] == DailyCumulativeCurrent.current:
-                stat_name += ':current'
             if stat_name not in data.columns:
                 continue
             data = data[data[stat_name].notna()]
@@ -442,22 +704,25 @@ class Model(object):
             data = data.reset_index(drop=True)
             y_data = data[stat_name]
             if self.options['daily'] == DailyCumulativeCurrent.daily:
-                y_data = y_data.diff()
-                # The very first entry will be NaN, set to 0 instead
-                y_data[0] = 0
-                average_size = self.options['daily_average_size']
-                if average_size > 1:
-                    y_data = y_data.rolling(
-                        window=average_size, min_periods=1).mean()
-
-            if pop_adj == PopulationAdjustment.per_million:
-                # for some reason, using /= here causes a different result
-                y_data = y_data / (data.population / 1e6)
-            elif pop_adj != PopulationAdjustment.raw:
+                y_data = daily_rolling_average(
+                    y_data.values, max(1, self.options['daily_average_size']))
+
+            data['y_raw'] = y_data
+            # for some reason, using /= here causes a different result
+            data['y_per_million'] = y_data / (population / 1e6)
+            if pop_adj not in POP_ADJ_COLUMN_SUFFIXES:
                 raise ValueError(pop_adj)
-            data['y'] = y_data
+            data['y'] = data['y' + POP_ADJ_COLUMN_SUFFIXES[pop_adj]]
 
-            if self.options['yscale'] == YAxisScaling.log:
+            if window_start is not None:
+                # drop the warm-up rows
+                in_window = data.date.values >= numpy.datetime64(window_start)
+                data = data[in_window].reset_index(drop=True)
+                if data.empty:
+                    continue
+
+            if apply_display_options \
+                    and self.options['yscale'] == YAxisScaling.log:
                 # if we're using logarithmic scaling, we can't display 0 values
                 # by filtering out 0's, we avoid two issues:
                 #   - we don't get odd-looking breaks in the graph
@@ -502,16 +767,139 @@ class Model(object):
             for key in serializeable.valid_query_keys():
                 if key in parsed_query:
                     these_items[key] = parsed_query.pop(key)
-                    print(these_items[key])
-            print(name, these_items)
             setattr(self, name, serializeable.from_query(these_items))
 
+        # options may have changed which stat we're graphing
+        self.set_data()
+
         if parsed_query:
             # make this more obvious to user?
             bad_keys = ', '.join(sorted(parsed_query))
             print("WARNING: unrecognized query keys: {}".format(bad_keys))
 
 
+def sources_info_html():
+    '''Returns a list of html snippets describing each data source, for the
+    Info tab'''
+    snippets = []
+    # was initially going to make this a set, but Source objects have a
+    # dict, and aren't immutable... also, number of sources is small enough
+    # that iterating over list should be fine
+    seen = []
+    for cache_item in datamod.data_cache.values():
+        retriever = cache_item.retriever
+        source = retriever.source()
+        if source in seen:
+            continue
+        seen.append(source)
+        # only report on data that's already been loaded - don't force a
+        # fetch of sources this session may never use.  Prefer an item
+        # from the same source that has been loaded.
+        metadata = cache_item.metadata
+        if metadata is None:
+            metadata = next(
+                (x.metadata for x in datamod.data_cache.values()
+                 if x.metadata is not None
+                 and x.retriever.source() == source), None)
+        lines = []
+        for data_type in retriever.data_types():
+            entity = data_type.entity
+            if isinstance(entity, Entity):
+                entity_name = str(entity)
+            else:
+                entity_name = entity.__name__
+            lines.append('<b>{} {}:</b>'.format(entity_name,
+                                                data_type.data_type))
+        lines.append('{}'.format(source.name))
+        links = ['<a href="{}">{}</a>'.format(url, name)
+                 for name, url in source.urls.items()]
+        links = ', '.join(links)
+        if metadata is not None and metadata.max_date is not None:
+            date = metadata.max_date.strftime('%a, %x')
+            lines.append('Most recent data: {}'.format(date))
+        lines.append('Links: {}'.format(links))
+        snippets.append('<br>'.join(lines))
+    return snippets
+
+
+class Bootstrap(object):
+    '''Everything a session with no query string needs that's the same for
+    every such session - the default entities, the Add tab's dropdown lists,
+    the Info tab's html, and the dataset for the default options
+
+    Computed once per data refresh (see default_bootstrap), so most new
+    sessions only have to make the bokeh models.
+    '''
+
+    def __init__(self, model, data_version):
+        self.data_version = data_version
+        self.entities = list(model.entities)
+        # {(entity type, sorted conditions): names}, as from
+        # Model.graphable_entities
+        self.graphable = {}
+        for entity_type in (Country, State):
+            self.graphable[entity_type, ()] = \
+                model.graphable_entities(entity_type)
+        conditions = (('state', DEFAULT_PICK_STATE),)
+        self.graphable[County, conditions] = \
+            model.graphable_entities(County, **dict(conditions))
+        self.dataset = model.make_dataset(apply_display_options=False)
+        # after making the dataset, so the data it used is reported on
+        self.info_html = sources_info_html()
+
+    def graphable_entities(self, entity_type, **conditions):
+        '''Returns the precomputed Model.graphable_entities result, or None'''
+        return self.graphable.get((entity_type,
+                                   tuple(sorted(conditions.items()))))
+
+
+_bootstrap = None
+# set while a new Bootstrap is being made, in dataset_executor
+_bootstrap_future = None
+_bootstrap_lock = threading.Lock()
+
+
+def _default_model():
+    model = Model()
+    for entity in DEFAULT_INITIAL_ENTITIES:
+        model.entities.add(entity)
+    return model
+
+
+def _make_bootstrap():
+    model = _default_model()
+    return Bootstrap(model, model.data_version())
+
+
+def _bootstrap_made(future):
+    global _bootstrap, _bootstrap_future
+    with _bootstrap_lock:
+        _bootstrap_future = None
+        if future.exception() is None:
+            _bootstrap = future.result()
+
+
+def default_bootstrap():
+    '''Returns the Bootstrap for the current data, or None if it isn't ready
+
+    Called on the io loop, so never refreshes data or makes the bootstrap
+    itself - if it's missing or out of date, a new one is made in
+    dataset_executor, for the sessions that come after.
+    '''
+    global _bootstrap_future
+    data_version = _default_model().data_version(refresh=False)
+    with _bootstrap_lock:
+        if _bootstrap is not None and _bootstrap.data_version == data_version:
+            return _bootstrap
+        if _bootstrap_future is not None:
+            return None
+        future = _bootstrap_future = dataset_executor.submit(_make_bootstrap)
+    # outside the lock, as this calls _bootstrap_made right away if it's
+    # already done
+    future.add_done_callback(_bootstrap_made)
+    return None
+
+
 class View(object):
     '''Contains the bokeh UI items, and is responsible for altering them
 
@@ -520,30 +908,94 @@ class View(object):
     UPDATE_FETCHING = 'Updated: Fetching'
 
     def __init__(self, doc, model):
+        '''doc may be None, to just make plots (see make_plot) - ie, for
+        rendering standalone files, with no bokeh server session'''
         self.model = model
         self.doc = doc
         self.controller = None
         self._last_data = None
+        self.figures = {}
+        self.sources = []
+        # {YAxisScaling: {entity id: ColumnDataSource}} - only populated when
+        # each entity gets it's own line (ie, not when using multi_line)
+        self.entity_sources = {}
+        # {YAxisScaling: {entity id: GlyphRenderer}} - likewise
+        self.entity_renderers = {}
+        # {YAxisScaling: [LegendItem]} - including those of hidden lines
+        self.legend_items = {}
+        self.multi_line = False
+        # {entity id: index into KELLY_COLORS} - see color
+        self._color_indices = {}
+        # {entity id: row} in the View/Remove tab
+        self.entity_rows = {}
+        self.display_callbacks = {}
+        # only set while building - see build
+        self._bootstrap = None
+        # we keep both a logarithmic and linear figure around - each needs it's
+        # own copy of the updated label
+        self.updated_titles = {
+            scaling: mdl.Title(text=self.UPDATE_FETCHING, align="right",
+                               text_font_size="8pt", text_font_style="normal")
+            for scaling in YAxisScaling
+        }
+        self.updated = self.updated_titles[YAxisScaling.log]
 
     # utility methods
 
     def color(self, entity):
-        i = self.model.entities.index(entity)
-        return KELLY_COLORS[i % len(KELLY_COLORS)]
+        '''Entities keep their color for as long as they're in the model, so
+        adding or removing one doesn't change the others' colors'''
+        if entity.id not in self._color_indices \
+                or len(self._color_indices) != len(self.model.entities):
+            self._assign_colors()
+        return KELLY_COLORS[self._color_indices[entity.id] % len(KELLY_COLORS)]
+
+    def _assign_colors(self):
+        # new entities get the lowest unused color - so when starting out,
+        # that's just their index
+        self._color_indices = {entity.id: self._color_indices[entity.id]
+                               for entity in self.model.entities
+                               if entity.id in self._color_indices}
+        used = set(self._color_indices.values())
+        unused = (i for i in itertools.count() if i not in used)
+        for entity in self.model.entities:
+            if entity.id not in self._color_indices:
+                self._color_indices[entity.id] = next(unused)
 
     def set_controller(self, controller):
         self.controller = controller
 
+    def graphable_entities(self, entity_type, **conditions):
+        if self._bootstrap is not None:
+            names = self._bootstrap.graphable_entities(entity_type,
+                                                       **conditions)
+            if names is not None:
+                return names
+        return self.model.graphable_entities(entity_type, **conditions)
+
     # build
 
-    def build(self):
-        '''constructs the main layout'''
+    def build(self, bootstrap=None):
+        '''constructs the main layout
+
+        If given, content is taken from bootstrap (see Bootstrap) instead of
+        being computed - only while building, since it's only valid for the
+        default options.
+        '''
+        self._bootstrap = bootstrap
+        try:
+            self._build()
+        finally:
+            self._bootstrap = None
+
+    def _build(self):
         self.doc.title = "Covid-19 Graphs"
 
         self.entities_layout = lyt.column([], width_policy="max")
         self.build_entity_ui_rows(self.entities_layout)
         self.add_entity_layout = self.build_add_entity_layout()
         self.options_layout = self.build_options_layout()
+        self.leaderboard_layout = self.build_leaderboard_layout()
         self.sources_layout = self.build_sources_layout()
 
         # Make tabs
@@ -551,10 +1003,13 @@ class View(object):
                                   title='View/Remove')
         self.add_tab = mdl.Panel(child=self.add_entity_layout, title='Add')
         self.options_tab = mdl.Panel(child=self.options_layout, title='Options')
+        self.leaderboard_tab = mdl.Panel(child=self.leaderboard_layout,
+                                         title='Leaders')
         self.sources_tab = mdl.Panel(child=self.sources_layout, title='Info')
         self.tabs = mdl.Tabs(tabs=[self.view_tab,
                                    self.add_tab,
                                    self.options_tab,
+                                   self.leaderboard_tab,
                                    self.sources_tab])
         for tab in self.tabs.tabs:
             tab.child.width_policy = 'min'
@@ -565,15 +1020,17 @@ class View(object):
         # actual plot will be replace by make_plot when we have data, and
         # are ready to draw
         self.plot = bokeh.plotting.figure(title="Dummy placeholder plot")
-        self.updated = mdl.Title(text=self.UPDATE_FETCHING, align="right",
-                                 text_font_size="8pt", text_font_style="normal")
         self.plot.add_layout(self.updated, "below")
 
         self.controls_plot = mdl.Row(self.tabs, self.plot)
         self.controls_plot.sizing_mode = "stretch_both"
 
         self.save_button = self.build_save_button()
-        self.main_layout = mdl.Column(self.controls_plot, self.save_button,
+        # shown from when a plot update is requested until it's applied
+        self.updating = mdl.Div(text="<i>Updating\u2026</i>", visible=False,
+                                name='updating')
+        self.main_layout = mdl.Column(self.controls_plot,
+                                      lyt.row(self.save_button, self.updating),
                                       sizing_mode='stretch_both')
         self.doc.add_root(self.main_layout)
 
@@ -583,49 +1040,47 @@ class View(object):
         """Add callbacks to display the last-updated time in the browser-local
         timezone.
         """
-        # Unfortunately, getting the timezone to show in the users's local time
-        # (instead of the server timezone) was tricky - the only thing that
-        # "knows" the local time is the browser, which means the updated time
-        # display string has to be updated via a javascript-callback;
-        # unfortunately, getting a javascript callback to fire just once, when
-        # the whole graph is first built (and not when, say, the user clicks a
-        # button) proved problematic - the only way I found was to make use
-        # of a periodic_callback, which modified a value that a javascript
-        # on change callback was watching.
+        # Getting the timezone to show in the users's local time (instead of
+        # the server timezone) is tricky - the only thing that "knows" the
+        # local time is the browser, which means the updated time display
+        # string has to be updated via a javascript-callback.  That callback
+        # fires once when the document is first ready, and then again whenever
+        # the server pushes a new update time (see update_updated_time).
 
         # Thanks to _jm and Bryan for their responses on this thread:
         #    https://discourse.bokeh.org/t/how-to-display-last-updated-information-in-local-time/5870
 
-        update_time_cds = mdl.ColumnDataSource(
+        self.update_time_source = mdl.ColumnDataSource(
             data={'t': [self.model.last_update_time()]})
 
-        update_text_cb = mdl.CustomJS(args=dict(source=update_time_cds),
-                                      code="""
+        update_text_cb = mdl.CustomJS(
+            args=dict(source=self.update_time_source,
+                      titles=list(self.updated_titles.values())),
+            code="""
             var localUpdateTime = new Date(source.data['t'][0])
-            cb_obj.text = "Updated: " + localUpdateTime.toString();
+            for (const title of titles) {
+                title.text = "Updated: " + localUpdateTime.toString();
+            }
         """)
-        self.updated.js_on_change('text', update_text_cb)
-
-        periods_holder = [0]
-        def modify_updated_time_placeholder(*args, **kwargs):
-            if not self.updated.text.startswith(self.UPDATE_FETCHING):
-                # print("periodic_callback removed...")
-                self.doc.remove_periodic_callback(periodic_callback)
-                return
-
-            # Just cycle between values with 1 to 3 trailing "." - this just
-            # makes sure that the value is always changed, so that as soon
-            # as javascript is "available", the javascript "on change" callback
-            # will fire.
-            num_periods = periods_holder[0]
-            # print("periodic_callback fired! {} - {} - {}"
-            #       .format(num_periods, args, kwargs))
-            periods_holder[0] = num_periods + 1
-            ellipsis = '.' * (num_periods % 3 + 1)
-            self.updated.text = self.UPDATE_FETCHING + ellipsis
-
-        periodic_callback = self.doc.add_periodic_callback(
-            modify_updated_time_placeholder, 1000)
+        self.doc.js_on_event('document_ready', update_text_cb)
+        self.update_time_source.js_on_change('data', update_text_cb)
+
+    def update_updated_time(self):
+        self.update_time_source.data = {'t': [self.model.last_update_time()]}
+
+    def set_updated_text(self, text):
+        '''Sets the updated label directly - for when there's no browser to run
+        the local-time callback (ie, standalone files)'''
+        for title in self.updated_titles.values():
+            title.text = text
+
+    def is_mobile(self):
+        session_context = getattr(self.doc, 'session_context', None)
+        if session_context is None or session_context.request is None:
+            # no browser (ie, rendering standalone files)
+            return False
+        return is_mobile_agent(
+            session_context.request.headers.get('User-Agent'))
 
     def build_save_button(self):
         save_button = mdl.Button(label='Save/Share', button_type="success")
@@ -674,7 +1129,10 @@ class View(object):
         else:
             active = []
         vis_check = mdl.CheckboxGroup(labels=[str(entity)], active=active,
-                                      width_policy="min")
+                                      width_policy="min",
+                                      name='visible:{}:{}'.format(
+                                          type(entity).__name__,
+                                          entity.serialize()))
 
         def update_visible(attr, old_visible_indices, visible_indices):
             del old_visible_indices
@@ -697,14 +1155,38 @@ class View(object):
         return lyt.row(vis_check, spacer, delete_button)
 
     def build_entity_ui_rows(self, entity_layout):
-        entity_layout.children = [self.build_entity_ui_row(e)
-                                  for e in self.model.entities]
+        self.entity_rows = {e.id: self.build_entity_ui_row(e)
+                            for e in self.model.entities}
+        entity_layout.children = list(self.entity_rows.values())
+
+    def insert_entity_ui_rows(self, entities):
+        '''Adds rows for just the given (newly added) entities'''
+        children = list(self.entities_layout.children)
+        # in model order, so every row before each insertion point is there
+        for entity in sorted(entities, key=self.model.entities.index):
+            row = self.build_entity_ui_row(entity)
+            self.entity_rows[entity.id] = row
+            children.insert(self.model.entities.index(entity), row)
+        self.entities_layout.children = children
+
+    def remove_entity_ui_row(self, entity):
+        row = self.entity_rows.pop(entity.id, None)
+        if row is not None:
+            self.entities_layout.children = [
+                x for x in self.entities_layout.children if x is not row]
+
+    def update_entity_ui_row(self, entity):
+        '''Sets one row's checkbox from the model'''
+        vis_check = self.entity_rows[entity.id].children[0]
+        is_visible = self.model.entities.is_visible(entity)
+        vis_check.active = [0] if is_visible else []
 
     def build_add_entity_layout(self):
         # Country
-        all_countries = self.model.graphable_entities(Country)
+        all_countries = self.graphable_entities(Country)
         self.pick_country_dropdown = mdl.Select(
-            title="Country:", value="Spain", options=all_countries)
+            title="Country:", value=DEFAULT_PICK_COUNTRY,
+            options=all_countries)
         self.add_country_button = mdl.Button(label="Add Country")
 
         def click_add_country():
@@ -714,9 +1196,10 @@ class View(object):
         self.add_country_button.on_click(click_add_country)
 
         # State
-        all_states = self.model.graphable_entities(State)
+        all_states = self.graphable_entities(State)
         self.pick_state_dropdown = mdl.Select(
-            title="US State:", value="California", options=all_states)
+            title="US State:", value=DEFAULT_PICK_STATE, options=all_states,
+            name='pick_state')
         self.add_state_button = mdl.Button(label="Add State")
 
         def click_add_state():
@@ -737,6 +1220,50 @@ class View(object):
 
         self.add_county_button.on_click(click_add_county)
 
+        self.add_all_counties_button = mdl.Button(
+            label="Add All Counties in State")
+
+        def click_add_all_counties():
+            self.controller.add_entities(
+                self.model.state_counties(self.pick_state_dropdown.value))
+
+        self.add_all_counties_button.on_click(click_add_all_counties)
+
+        # Province
+        all_provinces = self.model.graphable_provinces()
+        if DEFAULT_PICK_PROVINCE in all_provinces:
+            default_province = DEFAULT_PICK_PROVINCE.serialize()
+        else:
+            default_province = \
+                all_provinces[0].serialize() if all_provinces else ''
+        self.pick_province_dropdown = mdl.Select(
+            title="Province:", value=default_province,
+            options=[(x.serialize(), str(x)) for x in all_provinces])
+        self.add_province_button = mdl.Button(label="Add Province")
+
+        def click_add_province():
+            if self.pick_province_dropdown.value:
+                self.controller.add_entity(
+                    Province.deserialize(self.pick_province_dropdown.value))
+
+        self.add_province_button.on_click(click_add_province)
+
+        # Top N
+        entity_types = {x.__name__: x for x in ENTITY_TYPES}
+        self.pick_top_type_dropdown = mdl.Select(
+            title="Highest current value of graphed statistic:", value="State",
+            options=list(entity_types))
+        self.pick_top_count = mdl.Spinner(title="How many:", low=1, high=100,
+                                          step=1, value=DEFAULT_TOP_COUNT)
+        self.add_top_button = mdl.Button(label="Add Top")
+
+        def click_add_top():
+            entity_type = entity_types[self.pick_top_type_dropdown.value]
+            self.controller.add_entities(self.model.top_entities(
+                entity_type, int(self.pick_top_count.value)))
+
+        self.add_top_button.on_click(click_add_top)
+
         # update county values when state changes
 
         # Note that this callback is down here, because it does not involve
@@ -744,7 +1271,7 @@ class View(object):
         def pick_state_changed(attr, old_state, new_state):
             assert attr == 'value'
             del old_state
-            all_counties = self.model.graphable_entities(
+            all_counties = self.graphable_entities(
                 County, state=self.pick_state_dropdown.value)
             self.pick_county_dropdown.options = all_counties
             if all_counties:
@@ -765,28 +1292,100 @@ class View(object):
             self.pick_country_dropdown,
             self.add_country_button,
             spacer,
+            self.pick_province_dropdown,
+            self.add_province_button,
+            spacer,
             self.pick_state_dropdown,
             self.add_state_button,
             spacer,
             self.pick_county_dropdown,
             self.add_county_button,
+            self.add_all_counties_button,
+            spacer,
+            self.pick_top_type_dropdown,
+            self.pick_top_count,
+            self.add_top_button,
             spacer,
             note1,
         )
 
+    def build_leaderboard_layout(self):
+        entity_types = {x.__name__: x for x in ENTITY_TYPES}
+        self.leaderboard_type_dropdown = mdl.Select(
+            title="Current value of graphed statistic, for:", value="State",
+            options=list(entity_types))
+        self.leaderboard_order = mdl.RadioButtonGroup(
+            labels=["Highest", "Lowest"], active=0)
+        self.leaderboard_count = mdl.Spinner(title="How many:", low=1,
+                                             high=100, step=1,
+                                             value=DEFAULT_TOP_COUNT)
+        self.leaderboard_rows = lyt.column([], width_policy="max")
+
+        def selection_changed(attr, old, new):
+            del attr, old, new
+            self.update_leaderboard()
+
+        self.leaderboard_type_dropdown.on_change('value', selection_changed)
+        self.leaderboard_order.on_change('active', selection_changed)
+        self.leaderboard_count.on_change('value', selection_changed)
+        self.update_leaderboard()
+
+        return lyt.column(
+            self.leaderboard_type_dropdown,
+            self.leaderboard_order,
+            self.leaderboard_count,
+            mdl.Spacer(height=10),
+            self.leaderboard_rows,
+        )
+
+    def build_leaderboard_row(self, rank, entity, value):
+        label = mdl.Div(text="{}. {}: {:,.1f}".format(rank, entity, value),
+                        width_policy="max")
+        add_button = mdl.Button(label="+", button_type="success",
+                                max_height=25, width_policy="min",
+                                height_policy="min")
+
+        def add_entity():
+            self.controller.add_entity(entity)
+
+        add_button.on_click(add_entity)
+        return lyt.row(label, add_button)
+
+    def leaderboard_entity_type(self):
+        return {x.__name__: x for x in ENTITY_TYPES}[
+            self.leaderboard_type_dropdown.value]
+
+    def update_leaderboard(self):
+        entity_type = self.leaderboard_entity_type()
+        leaders = self.model.leaderboard(
+            entity_type, int(self.leaderboard_count.value),
+            lowest=(self.leaderboard_order.active == 1))
+        self.leaderboard_rows.children = [
+            self.build_leaderboard_row(rank, entity, value)
+            for rank, (entity, value) in enumerate(leaders, start=1)]
+
     def build_options_layout(self):
         self.option_uis = {}
         self._build_enumerated_option('ystat', "Statistic to graph:")
         ystat_select_ui = self.option_uis['ystat']
-        ystat_select_ui.on_change('value',
-                                  lambda attr, old, new: self.model.set_data())
+
+        def ystat_changed(attr, old, new):
+            del attr, old, new
+            self.model.set_data()
+            # the data items may have changed, so re-rank
+            self.update_leaderboard()
+
+        ystat_select_ui.on_change('value', ystat_changed)
         self._build_enumerated_option('yscale', "Graph scaling:")
         self._build_enumerated_option('xstat', "X axis:")
         self._build_enumerated_option('population_adjustment',
                                       "Popluation Adjustment:")
+        self._build_display_callbacks()
         self._build_enumerated_option('daily', "Daily/Cumulative:")
+        self._build_enumerated_option('date_window', "Dates:")
         self._build_int_option('daily_average_size',
                                "Averge daily value over past X days")
+        self._build_bool_option('webgl', "Use WebGL (faster with many lines)")
         return lyt.column(list(self.option_uis.values()))
 
     def _build_enumerated_option(self, option_name, title):
@@ -798,7 +1397,7 @@ class View(object):
         current = self.model.options[option_name].value
         select_ui = mdl.Select(
             title=title, value=current,
-            options=[x.value for x in enum_type])
+            options=[x.value for x in enum_type], name=option_name)
 
         def on_change(attr, old_state, new_state):
             assert attr == 'value'
@@ -809,89 +1408,279 @@ class View(object):
         self.option_uis[option_name] = select_ui
         return select_ui
 
+    def _build_display_callbacks(self):
+        '''Install the javascript that applies DISPLAY_ONLY_OPTIONS'''
+        # The args are filled in by update_display_callbacks, whenever we make
+        # a new plot
+        pop_adj_cb = mdl.CustomJS(code="""
+            const suffix = suffixes[cb_obj.value];
+            for (const source of sources) {
+                const data = Object.assign({}, source.data);
+                for (const column of ['y', 'ys']) {
+                    if ((column + suffix) in data) {
+                        data[column] = data[column + suffix];
+                    }
+                }
+                source.data = data;
+            }
+            for (const title of titles) {
+                title.text = title_texts[cb_obj.value];
+            }
+            for (const axis of axes) {
+                axis.axis_label = y_labels[cb_obj.value];
+            }
+        """)
+        self.option_uis['population_adjustment'].js_on_change('value',
+                                                              pop_adj_cb)
+        self.display_callbacks['population_adjustment'] = pop_adj_cb
+
+        yscale_cb = mdl.CustomJS(code="""
+            for (const [scaling, figure] of Object.entries(figures)) {
+                figure.visible = (scaling == cb_obj.value);
+            }
+        """)
+        self.option_uis['yscale'].js_on_change('value', yscale_cb)
+        self.display_callbacks['yscale'] = yscale_cb
+        self.update_display_callbacks()
+
+    def update_display_callbacks(self):
+        if not self.display_callbacks:
+            # no options ui (ie, making standalone plots)
+            return
+        figures = list(self.figures.values())
+        self.display_callbacks['population_adjustment'].args = dict(
+            suffixes={x.value: suffix
+                      for x, suffix in POP_ADJ_COLUMN_SUFFIXES.items()},
+            sources=self.sources,
+            titles=[x.title for x in figures],
+            axes=[x.yaxis[0] for x in figures],
+            title_texts={x.value: self.plot_title(x)
+                         for x in PopulationAdjustment},
+            y_labels={x.value: self.y_label(x) for x in PopulationAdjustment},
+        )
+        self.display_callbacks['yscale'].args = dict(
+            figures={scaling.value: figure
+                     for scaling, figure in self.figures.items()},
+        )
+
     def _build_int_option(self, option_name, title):
         current = self.model.options[option_name]
         select_ui = mdl.Slider(
-            title=title, value=current, start=1, end=30)
+            title=title, value=current, start=1, end=30, name=option_name)
 
         def on_change(attr, old_state, new_state):
-            assert attr == 'value'
+            assert attr == 'value_throttled'
             del old_state
             self.controller.set_option(option_name, new_state)
 
-        select_ui.on_change('value', on_change)
+        # value_throttled only changes when the slider is released, not for
+        # every value passed while dragging it
+        select_ui.on_change('value_throttled', on_change)
         self.option_uis[option_name] = select_ui
 
+    def _build_bool_option(self, option_name, title):
+        current = self.model.options[option_name]
+        check_ui = mdl.CheckboxGroup(labels=[title],
+                                     active=[0] if current else [],
+                                     name=option_name)
+
+        def on_change(attr, old_state, new_state):
+            assert attr == 'active'
+            del old_state
+            self.controller.set_option(option_name, bool(new_state))
+
+        check_ui.on_change('active', on_change)
+        self.option_uis[option_name] = check_ui
+
     def build_sources_layout(self):
-        divs = []
-        # was initially going to make this a set, but Source objects have a
-        # dict, and aren't immutable... also, number of sources is small enough
-        # that iterating over list should be fine
-        seen = []
-        for cache_item in datamod.data_cache.values():
-            retriever = cache_item.retriever
-            source = retriever.source()
-            if source in seen:
-                continue
-            seen.append(source)
-            lines = []
-            for data_type in retriever.data_types():
-                entity = data_type.entity
-                if isinstance(entity, Entity):
-                    entity_name = str(entity)
-                else:
-                    entity_name = entity.__name__
-                lines.append('<b>{} {}:</b>'.format(entity_name,
-                                                    data_type.data_type))
-            lines.append('{}'.format(source.name))
-            links = ['<a href="{}">{}</a>'.format(url, name)
-                     for name, url in source.urls.items()]
-            links = ', '.join(links)
-            date = cache_item.max_date()
-            if date is not None:
-                date = date.strftime('%a, %x')
-                lines.append('Most recent data: {}'.format(date))
-            lines.append('Links: {}'.format(links))
-            divs.append(mdl.Div(text='<br>'.join(lines)))
-        return lyt.column(divs)
+        if self._bootstrap is not None:
+            info_html = self._bootstrap.info_html
+        else:
+            info_html = sources_info_html()
+        return lyt.column([mdl.Div(text=x) for x in info_html])
+
+    def update_sources_info(self):
+        '''Updates the Info tab, ie, once data has been (re)loaded'''
+        info_html = sources_info_html()
+        divs = self.sources_layout.children
+        if len(divs) != len(info_html):
+            self.sources_layout.children = [mdl.Div(text=x)
+                                             for x in info_html]
+            return
+        for div, text in zip(divs, info_html):
+            if div.text != text:
+                div.text = text
 
-    def make_plot(self, data):
+    def y_label(self, pop_adj):
         y_label = '{} {}'.format(
             self.model.options['daily'].value.title(),
             self.model.options['ystat'].value.title(),
         )
-        pop_adj = self.model.options['population_adjustment']
         if pop_adj == PopulationAdjustment.per_million:
             y_label += '/million'
         elif pop_adj != PopulationAdjustment.raw:
             raise ValueError(pop_adj)
+        return y_label
+
+    def plot_title(self, pop_adj):
+        return "Covid 19 - {} by {}".format(
+            self.y_label(pop_adj), self.model.options['xstat'].value)
+
+    def make_plot(self, data):
+        '''Returns a layout holding the figure for the yscale option
+
+        The figure for the other scaling is only made if yscale is changed (see
+        ensure_figure) - after that, switching between them is done in the
+        browser, by the display callbacks.
+        '''
+        self.sources = []
+        self.figures = {}
+        self.entity_sources = {}
+        self.entity_renderers = {}
+        self.legend_items = {}
+        # with this many lines, a legend is useless - use hover instead
+        self.multi_line = len(data) > MULTI_LINE_THRESHOLD
+        scaling = self.model.options['yscale']
+        self.figures[scaling] = self.make_figure(scaling, data)
+        self.update_display_callbacks()
+        return lyt.column(list(self.figures.values()),
+                          sizing_mode="stretch_both")
+
+    def ensure_figure(self, scaling):
+        '''Adds the figure for the given scaling to the plot, if it's not
+        already there'''
+        if scaling in self.figures or self._last_data is None:
+            return
+        figure = self.make_figure(scaling, self._last_data)
+        # the display callback will already have hidden the other figures
+        self.figures[scaling] = figure
+        if scaling in self.legend_items:
+            # some of the lines may have been hidden since the plot was made
+            self._update_legend(scaling)
+        self.plot.children = list(self.plot.children) + [figure]
+        self.update_display_callbacks()
+
+    def make_figure(self, scaling, data):
+        pop_adj = self.model.options['population_adjustment']
+        y_suffix = POP_ADJ_COLUMN_SUFFIXES[pop_adj]
         xstat = self.model.options['xstat']
         x_axis_type = 'auto'
         if xstat == XAxisStat.date:
             x_axis_type = 'datetime'
-        title = "Covid 19 - {} by {}".format(y_label, xstat.value)
-        plot = bokeh.plotting.figure(title=title,
+        plot = bokeh.plotting.figure(title=self.plot_title(pop_adj),
             x_axis_label=xstat.value, x_axis_type=x_axis_type,
-            y_axis_label=y_label, y_axis_type=self.model.options['yscale'].name)
-        user_agent = self.doc.session_context.request.headers.get('User-Agent')
-        is_mobile = is_mobile_agent(user_agent)
-        if is_mobile:
+            y_axis_label=self.y_label(pop_adj), y_axis_type=scaling.name,
+            output_backend='webgl' if self.model.options['webgl'] else 'canvas')
+        if self.is_mobile():
             # disable the toolbar on mobile, as it's annoying
             plot.toolbar_location = None
             plot.toolbar.active_drag = None
             plot.toolbar.active_scroll = None
 
-        plot.add_layout(self.updated, "below")
-
-        for entity, line_data in data:
-            plot.line(x='x', y='y', source=line_data,
-                      line_width=3, color=self.color(entity),
-                      legend_label=str(entity))
+        plot.add_layout(self.updated_titles[scaling], "below")
+
+        if scaling == YAxisScaling.log:
+            # if we're using logarithmic scaling, we can't display 0 values
+            # by filtering out 0's, we avoid two issues:
+            #   - we don't get odd-looking breaks in the graph
+            #   - if a dataset starts with a long series of 0s (ie, deaths),
+            #     we don't set the left edge of our graph to a point way
+            #     before we actually have something to graph
+            data = [(entity, line_data[line_data.y_raw.values > 0])
+                    for entity, line_data in data]
+
+        if self.multi_line:
+            source_data = {
+                'xs': [line_data.x.values for _, line_data in data],
+                'color': [hex_color(self.color(entity)) for entity, _ in data],
+                'label': [str(entity) for entity, _ in data],
+            }
+            for suffix in POP_ADJ_COLUMN_SUFFIXES.values():
+                source_data['ys' + suffix] = [line_data['y' + suffix].values
+                                              for _, line_data in data]
+            source_data['ys'] = source_data['ys' + y_suffix]
+            source = mdl.ColumnDataSource(data=source_data)
+            self.sources.append(source)
+            plot.multi_line(xs='xs', ys='ys', source=source, line_width=2,
+                            color='color')
+            plot.add_tools(mdl.HoverTool(tooltips=[('', '@label')]))
+        else:
+            self.entity_sources[scaling] = {}
+            self.entity_renderers[scaling] = {}
+            self.legend_items[scaling] = []
+            for entity, line_data in data:
+                self._add_line(scaling, plot, entity, line_data)
 
         plot.legend.location = "top_left"
         plot.sizing_mode = "stretch_both"
         return plot
 
+    def _add_line(self, scaling, figure, entity, line_data):
+        source = mdl.ColumnDataSource(data=self.source_data(line_data))
+        self.sources.append(source)
+        self.entity_sources[scaling][entity.id] = source
+        renderer = figure.line(x='x', y='y', source=source,
+                               line_width=3, color=self.color(entity),
+                               legend_label=str(entity))
+        renderer.visible = self.model.entities.is_visible(entity)
+        self.entity_renderers[scaling][entity.id] = renderer
+        # legend_label either made a new item, or added to one with the same
+        # label
+        legend_items = self.legend_items[scaling]
+        for legend in figure.legend:
+            for item in legend.items:
+                if any(x is renderer for x in item.renderers) \
+                        and not any(x is item for x in legend_items):
+                    legend_items.append(item)
+        return renderer
+
+    def source_data(self, line_data):
+        '''Returns the ColumnDataSource columns for one entity's line'''
+        pop_adj = self.model.options['population_adjustment']
+        source_data = {'x': line_data.x.values}
+        for suffix in POP_ADJ_COLUMN_SUFFIXES.values():
+            source_data['y' + suffix] = line_data['y' + suffix].values
+        source_data['y'] = source_data['y' + POP_ADJ_COLUMN_SUFFIXES[pop_adj]]
+        return source_data
+
+    @staticmethod
+    def _is_prefix(old_data, new_data):
+        if len(new_data) < len(old_data):
+            return False
+        new_prefix = new_data.iloc[:len(old_data)]
+        return (numpy.array_equal(old_data.x.values, new_prefix.x.values)
+                and numpy.array_equal(old_data.y_raw.values,
+                                      new_prefix.y_raw.values, equal_nan=True))
+
+    def stream_plot(self, data):
+        '''Updates the plot with newly refreshed data
+
+        If the new data just extends what's already graphed, only the new
+        points are sent to the browser (with ColumnDataSource.stream);
+        otherwise, the whole plot is rebuilt.
+        '''
+        old_data = self._last_data
+        can_stream = (
+            old_data is not None
+            and self.entity_sources
+            and [x[0] for x in old_data] == [x[0] for x in data]
+            and all(self._is_prefix(old, new)
+                    for (_, old), (_, new) in zip(old_data, data))
+        )
+        if not can_stream:
+            self.update_plot(data)
+            return
+
+        for (entity, old), (_, new) in zip(old_data, data):
+            new_rows = new.iloc[len(old):]
+            for scaling, sources in self.entity_sources.items():
+                rows = new_rows
+                if scaling == YAxisScaling.log:
+                    rows = rows[rows.y_raw.values > 0]
+                if not rows.empty:
+                    sources[entity.id].stream(self.source_data(rows))
+        self._last_data = data
+
     def update_plot(self, data=None):
         if data is None:
             if self._last_data is None:
@@ -907,6 +1696,107 @@ class View(object):
     def update_visibility(self):
         self.build_entity_ui_rows(self.entities_layout)
 
+    # Incremental plot updates - these only work when each entity has it's own
+    # lines (not with multi_line), and return False when the whole plot needs
+    # to be updated instead
+
+    def has_entity_lines(self):
+        return bool(self.figures) and not self.multi_line
+
+    def can_add_lines(self, count):
+        if not self.has_entity_lines():
+            return False
+        # every figure has the same lines
+        renderers = next(iter(self.entity_renderers.values()))
+        num_visible = sum(1 for x in renderers.values() if x.visible)
+        return num_visible + count <= MULTI_LINE_THRESHOLD
+
+    def add_lines(self, data):
+        '''Adds lines for the given (entity, line data) pairs, as returned by
+        Model.make_dataset(apply_display_options=False)'''
+        if not self.can_add_lines(len(data)):
+            return False
+        for scaling, figure in self.figures.items():
+            for entity, line_data in data:
+                if scaling == YAxisScaling.log:
+                    # see make_figure
+                    line_data = line_data[line_data.y_raw.values > 0]
+                self._add_line(scaling, figure, entity, line_data)
+            # if there weren't any lines, this is a new legend
+            figure.legend.location = "top_left"
+            self._update_legend(scaling)
+        # a new list - the old one may be shared (see Bootstrap)
+        indices = self.model.entities.indices()
+        self._last_data = sorted(self._last_data + list(data),
+                                 key=lambda x: indices[x[0].id])
+        # so switching population adjustment in the browser covers new lines
+        self.update_display_callbacks()
+        return True
+
+    def remove_line(self, entity):
+        if not self.has_entity_lines():
+            return False
+        for scaling, figure in self.figures.items():
+            source = self.entity_sources[scaling].pop(entity.id, None)
+            if source is not None:
+                self.sources = [x for x in self.sources if x is not source]
+            renderer = self.entity_renderers[scaling].pop(entity.id, None)
+            if renderer is None:
+                # it had no data to graph
+                continue
+            figure.renderers = [x for x in figure.renderers
+                                if x is not renderer]
+            for item in self.legend_items[scaling]:
+                if any(x is renderer for x in item.renderers):
+                    item.renderers = [x for x in item.renderers
+                                      if x is not renderer]
+            self.legend_items[scaling] = [
+                x for x in self.legend_items[scaling] if x.renderers]
+            self._update_legend(scaling)
+        self._last_data = [x for x in self._last_data
+                           if x[0].id != entity.id]
+        self.update_display_callbacks()
+        return True
+
+    def set_line_visible(self, entity, visible):
+        '''Shows or hides an entity's already-made lines
+
+        Returns False when showing an entity that has no lines yet, since its
+        data still needs to be made (see add_lines).
+        '''
+        if not self.has_entity_lines():
+            return False
+        found = False
+        for scaling in self.figures:
+            renderer = self.entity_renderers[scaling].get(entity.id)
+            if renderer is not None:
+                renderer.visible = visible
+                self._update_legend(scaling)
+                found = True
+        return found or not visible
+
+    def _update_legend(self, scaling):
+        '''Lists just the visible lines in the legend, in entity order'''
+        indices = self.model.entities.indices()
+        renderer_indices = {
+            renderer.id: indices[entity_id]
+            for entity_id, renderer in self.entity_renderers[scaling].items()
+            if renderer.visible and entity_id in indices
+        }
+
+        def item_index(item):
+            return min(renderer_indices[x.id] for x in item.renderers
+                       if x.id in renderer_indices)
+
+        items = sorted((x for x in self.legend_items[scaling]
+                        if any(r.id in renderer_indices for r in x.renderers)),
+                       key=item_index)
+        for legend in self.figures[scaling].legend:
+            legend.items = items
+
+    def set_updating(self, updating):
+        self.updating.visible = updating
+
 
 class Controller(object):
     '''Main class for making changes
@@ -918,41 +1808,177 @@ class Controller(object):
         self.model = model
         self.view = view
         self.view.set_controller(self)
+        self._data_version = None
+        self._refresh_token = None
+        # incremented for every dataset requested - only the latest is applied
+        self._dataset_request = 0
+        # the last of those that was applied
+        self._applied_dataset_request = 0
+        # set while a coalesced plot update is waiting to run
+        self._pending_plot_update = None
+        # how many add_lines requests are still being made
+        self._pending_lines = 0
 
     def start(self, query=None):
         # initial entities to graph
+        bootstrap = None
         if not query:
-            initial_entities = DEFAULT_INITIAL_ENTITIES
-            for entity in initial_entities:
+            # the default view is the same for every session, so much of it is
+            # usually already made - if not, this session makes it's own,
+            # like any other
+            bootstrap = default_bootstrap()
+            entities = DEFAULT_INITIAL_ENTITIES
+            if bootstrap is not None:
+                entities = bootstrap.entities
+            for entity in entities:
                 self.model.entities.add(entity)
         else:
             self.model.set_from_query_dict(query)
 
         # build view after getting the model, so initial settings are right
-        self.view.build()
+        self.view.build(bootstrap)
 
-        # update the visibility widget and the plot
-        self.update_all_visible()
+        # update the visibility widget and the plot - no need to wait for more
+        # changes to coalesce with
+        if bootstrap is None:
+            self.view.update_visibility()
+            self.flush_plot_update()
+        else:
+            self.view.update_visibility()
+            self.view.update_plot(bootstrap.dataset)
+            self._data_version = bootstrap.data_version
+
+        # for memory accounting (see memory.py)
+        memory.track_session(self)
+
+        # get told about new data, instead of polling for it
+        self._refresh_token = refresh_notifier.subscribe(self.on_data_refreshed)
+        self.view.doc.on_session_destroyed(self.on_session_destroyed)
+
+    def on_session_destroyed(self, session_context):
+        del session_context
+        refresh_notifier.unsubscribe(self._refresh_token)
+
+    def on_data_refreshed(self, cache_item):
+        # may be called from another session's callback (or the server's
+        # periodic refresh), so hop onto our own document's event loop
+        if any(cache_item is x for x in self.model.data_items.values()):
+            self.view.doc.add_next_tick_callback(
+                functools.partial(self.refresh_data, cache_item))
+
+    def refresh_data(self, cache_item):
+        # runs on the io loop, so don't refresh anything here - that's left to
+        # the server's refresh (see server.start_refreshing), which tells us
+        # about each item as it's done
+        leaderboard_type = self.view.leaderboard_entity_type()
+        if cache_item is self.model.data_items.get(leaderboard_type):
+            self.view.update_leaderboard()
+        version = self.model.data_version(refresh=False)
+        if version == self._data_version:
+            # we already graphed this data
+            return
+        self.view.update_updated_time()
+        self._request_dataset(self.view.stream_plot)
 
     def add_entity(self, entity):
-        if entity in self.model.entities:
+        self.add_entities([entity])
+
+    def add_entities(self, entities):
+        new_entities = [x for x in entities if x not in self.model.entities]
+        if not new_entities:
             return
-        self.model.entities.add(entity)
-        assert self.model.entities.is_visible(entity)
-        self.view.update_visibility()
-        self.update_plot()
+        for entity in new_entities:
+            self.model.entities.add(entity)
+            assert self.model.entities.is_visible(entity)
+        self.view.insert_entity_ui_rows(new_entities)
+        self.add_lines(new_entities)
 
     def remove_entity(self, entity):
         self.model.entities.remove(entity)
-        self.view.update_visibility()
-        self.update_plot()
+        self.view.remove_entity_ui_row(entity)
+        if self._plot_update_outstanding() \
+                or not self.view.remove_line(entity):
+            self.update_plot()
 
     def set_option(self, option_name, value):
         self.model.options[option_name] = value
+        if option_name in LEADERBOARD_OPTIONS:
+            self.view.update_leaderboard()
+        if option_name == 'yscale':
+            self.view.ensure_figure(value)
+        if option_name in DISPLAY_ONLY_OPTIONS:
+            # already applied in the browser - nothing to recompute
+            return
         self.update_plot()
 
     def update_plot(self):
-        self.view.update_plot(self.model.make_dataset())
+        '''Schedules a plot update, PLOT_UPDATE_DELAY_MS from now
+
+        Any more requests made before then are handled by the same update, so a
+        burst of changes only makes one new dataset and plot.  The model is
+        read when the update runs, so it sees every change.
+        '''
+        if self._pending_plot_update is not None:
+            return
+        self.view.set_updating(True)
+        self._pending_plot_update = self.view.doc.add_timeout_callback(
+            self.flush_plot_update, PLOT_UPDATE_DELAY_MS)
+
+    def flush_plot_update(self):
+        '''Starts a plot update now, instead of waiting for update_plot's'''
+        if self._pending_plot_update is not None:
+            try:
+                self.view.doc.remove_timeout_callback(self._pending_plot_update)
+            except ValueError:
+                # it's what called us, and so is already gone
+                pass
+            self._pending_plot_update = None
+        self._request_dataset(self.view.update_plot)
+
+    def _request_dataset(self, apply):
+        '''Computes the dataset for the model's current state in
+        dataset_executor, then calls apply with it, back on the document's
+        event loop
+
+        If another dataset is requested before this one is done, this one is
+        dropped.
+        '''
+        self._dataset_request += 1
+        request = self._dataset_request
+        snapshot = self.model.snapshot()
+        self.view.set_updating(True)
+        future = dataset_executor.submit(self._compute_dataset, snapshot)
+
+        def done(future):
+            # called from the worker thread
+            self.view.doc.add_next_tick_callback(
+                functools.partial(self._apply_dataset, request, future, apply))
+
+        future.add_done_callback(done)
+
+    @staticmethod
+    def _compute_dataset(snapshot):
+        # get the version first - if the data is refreshed while making the
+        # dataset, we'll then just make it again
+        version = snapshot.data_version()
+        return version, snapshot.make_dataset(apply_display_options=False)
+
+    def _apply_dataset(self, request, future, apply):
+        if request != self._dataset_request:
+            # superseded by a newer request
+            return
+        self._applied_dataset_request = request
+        try:
+            version, data = future.result()
+            if version != self._data_version:
+                # the Info tab only reports on data that's been loaded
+                self.view.update_sources_info()
+            self._data_version = version
+            apply(data)
+        finally:
+            # not until the plot's updated, so anything watching the indicator
+            # (ie, loadtest) sees the new plot once it's off
+            self._update_updating()
 
     def update_all_visible(self, visible_entities=None, update_view=True,
                            update_plot=True):
@@ -969,17 +1995,112 @@ class Controller(object):
                        update_plot=True):
         self.model.entities.set_visibility(entity, visible)
         if update_view:
-            self.view.update_visibility()
-        if update_plot:
+            self.view.update_entity_ui_row(entity)
+        if not update_plot:
+            return
+        if visible:
+            self.add_lines([entity])
+        elif self._plot_update_outstanding() \
+                or not self.view.set_line_visible(entity, False):
+            self.update_plot()
+
+    def _update_updating(self):
+        '''Shows the "Updating..." indicator while a whole-plot update or
+        add_lines is outstanding'''
+        self.view.set_updating(self._plot_update_outstanding()
+                               or self._pending_lines > 0)
+
+    def _plot_update_outstanding(self):
+        '''Whether a whole-plot update is scheduled or being computed - if so,
+        changes can't be made to the current plot, as it's about to be
+        replaced'''
+        return (self._pending_plot_update is not None
+                or self._applied_dataset_request != self._dataset_request)
+
+    def add_lines(self, entities):
+        '''Adds lines for the given (visible) entities to the plot
+
+        Only their data is made - or, if that can't be done, the whole plot is
+        updated.  Lines that were just hidden are shown again, without making
+        any data.
+        '''
+        if self._plot_update_outstanding():
+            self.update_plot()
+            return
+        entities = [x for x in entities
+                    if not self.view.set_line_visible(x, True)]
+        if not entities:
+            return
+        if not self.view.can_add_lines(len(entities)):
             self.update_plot()
+            return
+        request = self._dataset_request
+        snapshot = self.model.snapshot()
+        self._pending_lines += 1
+        self.view.set_updating(True)
+        future = dataset_executor.submit(self._compute_lines, snapshot,
+                                         entities)
+
+        def done(future):
+            # called from the worker thread
+            self.view.doc.add_next_tick_callback(
+                functools.partial(self._apply_lines, request, future))
+
+        future.add_done_callback(done)
+
+    @staticmethod
+    def _compute_lines(snapshot, entities):
+        return snapshot.make_dataset(apply_display_options=False,
+                                     entities=entities)
+
+    def _apply_lines(self, request, future):
+        self._pending_lines -= 1
+        try:
+            if request != self._dataset_request:
+                # a whole-plot update was requested since, which includes these
+                return
+            data = []
+            for entity, line_data in future.result():
+                # they may have been removed or hidden while we were making
+                # them - or shown again, after an earlier add_lines made their
+                # lines
+                if entity not in self.model.entities \
+                        or not self.model.entities.is_visible(entity) \
+                        or self.view.set_line_visible(entity, True):
+                    continue
+                data.append((entity, line_data))
+            if data and not self.view.add_lines(data):
+                self.update_plot()
+        finally:
+            self._update_updating()
 
 
 def modify_doc(doc):
+    query = dict(doc.session_context.request.arguments)
+    # always pops the profiling flag, so set_from_query_dict never sees it
+    profiler = profiling.profiler_for_query(query)
+    if profiler is None:
+        _modify_doc(doc, query)
+        return
+
+    profiler.call(_modify_doc, doc, query,
+                  wrap_controller=profiler.wrap_controller)
+
+    def dump_profile(session_context):
+        path = profiler.dump(session_context.id)
+        print("Wrote session profile: {}".format(path))
+
+    doc.on_session_destroyed(dump_profile)
+
+
+def _modify_doc(doc, query, wrap_controller=None):
     model = Model()
     view = View(doc, model)
     controller = Controller(model, view)
-    query = doc.session_context.request.arguments
+    if wrap_controller is not None:
+        wrap_controller(controller)
     controller.start(query=query)
+    return controller
 
 
 if __name__ == '__main__':
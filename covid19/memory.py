@@ -0,0 +1,125 @@
+'''Memory accounting for cache items, live sessions, and the whole process
+
+Served as json from the /api/stats endpoint (see api.py), so growth can be
+watched over time - ie, to catch sessions that are never cleaned up.
+'''
+
+import enum
+import sys
+import weakref
+
+import numpy
+import pandas
+
+from typing import Any, Dict, Optional
+
+from . import datamod
+
+
+# every Controller that has been started, and not yet garbage collected - so a
+# session that's gone but still listed here is a leak
+live_sessions = weakref.WeakSet()
+
+
+def track_session(controller) -> None:
+    live_sessions.add(controller)
+
+
+def deep_sizeof(obj: Any, seen: Optional[set] = None) -> int:
+    '''Approximate bytes used by obj, and everything it contains
+
+    Objects reachable more than once (by identity) are only counted once.
+    '''
+    if seen is None:
+        seen = set()
+    if obj is None or isinstance(obj, enum.Enum) or id(obj) in seen:
+        # enum members are shared singletons
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, (pandas.DataFrame, pandas.Series, pandas.Index)):
+        usage = obj.memory_usage(deep=True)
+        return int(usage.sum() if isinstance(usage, pandas.Series) else usage)
+    if isinstance(obj, numpy.ndarray):
+        # views share their base's memory
+        return obj.nbytes if obj.base is None else sys.getsizeof(obj)
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen)
+                    for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(x, seen) for x in obj)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+        size += deep_sizeof(vars(obj), seen)
+    return size
+
+
+def process_rss_bytes(pid='self') -> Optional[int]:
+    '''Resident set size, from /proc (so None if not on linux)'''
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def cache_item_usage(item) -> Dict[str, Any]:
+    frame_storage = item.frame_storage()
+    components = {
+        'frame': 0 if frame_storage is None else frame_storage.memory_bytes(),
+    }
+    seen = set()
+    for name, derived in item.derived_data().items():
+        components[name] = deep_sizeof(derived, seen)
+    return {
+        'loaded': item.is_loaded(),
+        'version': item.version,
+        'storage': None if frame_storage is None
+                   else type(frame_storage).__name__,
+        'spilled': getattr(frame_storage, 'is_spilled', lambda: False)(),
+        # only for column storage
+        'loaded_columns': getattr(frame_storage, 'loaded_columns',
+                                  lambda: None)(),
+        'bytes': components,
+        'total_bytes': sum(components.values()),
+    }
+
+
+def session_usage(controller) -> Dict[str, Any]:
+    view = controller.view
+    session_context = getattr(view.doc, 'session_context', None)
+    seen = set()
+    components = {
+        'model': deep_sizeof(
+            {'entities': controller.model.entities,
+             'options': controller.model.options}, seen),
+        'last_data': deep_sizeof(view._last_data, seen),
+        'plot_sources': deep_sizeof([x.data for x in view.sources], seen),
+    }
+    return {
+        'session_id': None if session_context is None else session_context.id,
+        'num_entities': len(controller.model.entities),
+        'bytes': components,
+        'total_bytes': sum(components.values()),
+    }
+
+
+def stats() -> Dict[str, Any]:
+    cache = {repr(key): cache_item_usage(item)
+             for key, item in datamod.data_cache.items()}
+    sessions = [session_usage(x) for x in list(live_sessions)]
+    # only set if there's a COVID19_CACHE_MEMORY_BUDGET_MB (see storage.py)
+    budget = getattr(datamod.data_cache.storage_factory, 'budget', None)
+    return {
+        'process': {
+            'rss_bytes': process_rss_bytes(),
+            'cache_bytes': sum(x['total_bytes'] for x in cache.values()),
+            'session_bytes': sum(x['total_bytes'] for x in sessions),
+            'num_sessions': len(sessions),
+        },
+        'budget': None if budget is None else budget.stats(),
+        'cache': cache,
+        'sessions': sessions,
+    }
@@ -0,0 +1,210 @@
+'''Opt-in profiling of individual sessions
+
+For when a particular shared link is slow: add _profile=TOKEN to it, where
+TOKEN is one of the comma-separated tokens in the server's COVID19_PROFILE_TOKENS
+environment variable.  That session's modify_doc, and every controller
+callback it makes afterwards (including the datasets made for it in worker
+threads), are run under cProfile, and the stats are written to
+COVID19_PROFILE_DIR (default: covid19_profiles in the temp dir) when the
+session ends - one file per session.  Without a matching token, the flag is
+ignored (and no one else's sessions are affected).
+
+To summarize the hottest functions across all the captured sessions:
+    python -m covid19.profiling summarize [DIR] [--sort KEY] [--top N]
+'''
+
+import argparse
+import cProfile
+import datetime
+import functools
+import glob
+import os
+import pstats
+import re
+import tempfile
+import threading
+
+from typing import Dict, List, Optional
+
+
+PROFILE_QUERY_KEY = '_profile'
+TOKENS_ENV_VAR = 'COVID19_PROFILE_TOKENS'
+DIR_ENV_VAR = 'COVID19_PROFILE_DIR'
+
+# the Controller methods that the View's callbacks (and refreshes) go through
+PROFILED_CONTROLLER_METHODS = [
+    '_apply_dataset',
+    '_apply_lines',
+    'add_entities',
+    'add_entity',
+    'add_lines',
+    'flush_plot_update',
+    'refresh_data',
+    'remove_entity',
+    'set_option',
+    'update_all_visible',
+    'update_plot',
+    'update_visible',
+]
+
+# the Controller methods that are run in main.dataset_executor's threads -
+# which is where datasets are actually made
+PROFILED_WORKER_METHODS = [
+    '_compute_dataset',
+    '_compute_lines',
+]
+
+
+def profile_dir() -> str:
+    return os.environ.get(DIR_ENV_VAR) or os.path.join(tempfile.gettempdir(),
+                                                       'covid19_profiles')
+
+
+def allowed_tokens() -> List[str]:
+    return [x for x in os.environ.get(TOKENS_ENV_VAR, '').split(',') if x]
+
+
+class SessionProfiler(object):
+    '''Accumulates a cProfile profile over all of one session's calls'''
+
+    def __init__(self, token: str):
+        self.token = token
+        self.profile = cProfile.Profile()
+        # calls nest (ie, add_entity -> add_entities -> update_plot), but the
+        # profiler should only be turned on / off by the outermost
+        self._depth = 0
+        # cProfile only sees the thread that enabled it, so calls in other
+        # threads are profiled separately, and merged in here
+        self._worker_stats = None
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        with self._lock:
+            self._depth += 1
+            if self._depth == 1:
+                self.profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.profile.disable()
+
+    def call_in_worker(self, func, *args, **kwargs):
+        '''Like call, for functions run in some other thread than the
+        session's - each call gets it's own profile'''
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            self._add_worker_profile(profile)
+
+    def _add_worker_profile(self, profile: cProfile.Profile) -> None:
+        try:
+            stats = pstats.Stats(profile)
+        except TypeError:
+            # nothing was recorded
+            return
+        with self._lock:
+            if self._worker_stats is None:
+                self._worker_stats = stats
+            else:
+                self._worker_stats.add(stats)
+
+    def wrap(self, func, in_worker: bool = False):
+        call = self.call_in_worker if in_worker else self.call
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return call(func, *args, **kwargs)
+        return wrapper
+
+    def wrap_methods(self, obj, names: List[str],
+                     in_worker: bool = False) -> None:
+        '''Replaces the named methods of obj (just that instance) with profiled
+        versions'''
+        for name in names:
+            setattr(obj, name, self.wrap(getattr(obj, name),
+                                         in_worker=in_worker))
+
+    def wrap_controller(self, controller) -> None:
+        self.wrap_methods(controller, PROFILED_CONTROLLER_METHODS)
+        self.wrap_methods(controller, PROFILED_WORKER_METHODS, in_worker=True)
+
+    def dump(self, session_id: str) -> str:
+        '''Writes the stats collected so far, and returns the file path'''
+        directory = profile_dir()
+        os.makedirs(directory, exist_ok=True)
+        timestamp = datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+        name = '{}_{}_{}.prof'.format(
+            timestamp, re.sub(r'\W+', '_', self.token),
+            re.sub(r'\W+', '_', session_id))
+        path = os.path.join(directory, name)
+        with self._lock:
+            if self._worker_stats is None:
+                self.profile.dump_stats(path)
+                return path
+            # a copy, so workers can go on adding to the original
+            stats = pstats.Stats()
+            stats.add(self._worker_stats)
+        try:
+            stats.add(pstats.Stats(self.profile))
+        except TypeError:
+            # nothing was recorded in the session's own thread
+            pass
+        stats.dump_stats(path)
+        return path
+
+
+def profiler_for_query(query: Dict[str, List[bytes]]) \
+        -> Optional[SessionProfiler]:
+    '''Returns a SessionProfiler if the query asks for one with an allowed
+    token, else None
+
+    The flag is always removed from query, so set_from_query_dict never sees
+    it.
+    '''
+    values = query.pop(PROFILE_QUERY_KEY, None)
+    if not values:
+        return None
+    token = values[-1].decode('utf-8')
+    if token not in allowed_tokens():
+        return None
+    return SessionProfiler(token)
+
+
+################################################################################
+# Summarizing
+
+def summarize(paths: List[str], sort: str = 'cumulative', top: int = 30):
+    stats = pstats.Stats(paths[0])
+    for path in paths[1:]:
+        stats.add(path)
+    print('{} session(s)'.format(len(paths)))
+    stats.strip_dirs().sort_stats(sort).print_stats(top)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    summarize_parser = subparsers.add_parser(
+        'summarize', help='print the hottest functions across sessions')
+    summarize_parser.add_argument('directory', nargs='?', default=None,
+                                  help='default: {}'.format(profile_dir()))
+    summarize_parser.add_argument('--sort', default='cumulative',
+                                  help='any pstats sort key, ie: tottime')
+    summarize_parser.add_argument('--top', type=int, default=30)
+    args = parser.parse_args(argv)
+
+    directory = args.directory or profile_dir()
+    paths = sorted(glob.glob(os.path.join(directory, '*.prof')))
+    if not paths:
+        parser.exit(1, 'no .prof files in {}\n'.format(directory))
+    summarize(paths, sort=args.sort, top=args.top)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,15 +4,25 @@ import attr
 
 import abc
 import datetime
+import enum
+import hashlib
 import inspect
+import io
+import numpy
 import pandas
 import pathlib
 import os
+import re
+import threading
+import time
 import typing
+import urllib.request
+import weakref
 
 from . import entities
+from . import storage
 
-from typing import List, Optional, Tuple, Type, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
 
 THIS_FILE = inspect.getsourcefile(lambda: None)
 
@@ -90,33 +100,640 @@ class DataRetriever(abc.ABC):
     def retrieve(self) -> pandas.DataFrame:
         raise NotImplementedError()
 
+    def entity_joins(self) -> List[Tuple['IndexedJoin', 'DataCacheItem']]:
+        '''Joins that add per-entity columns (ie, population)
+
+        These are applied to the cache item's entity index - one row per
+        entity - rather than being repeated on every row of the time series.
+        '''
+        return []
+
+    def payload_urls(self) -> List[str]:
+        '''The urls of the raw payloads that retrieve() reads'''
+        return [self.source().urls['data']]
+
+    def fingerprint(self) -> Optional[str]:
+        '''Returns a hash of everything retrieve() would process, or None if
+        that can't be known without running it
+
+        If the fingerprint is unchanged since the last retrieve(), the cache
+        can keep it's existing data.  The default downloads and hashes the
+        payload_urls, and holds onto the bytes, so the retrieve() that may
+        follow doesn't need to download them again.
+        '''
+        digest = hashlib.sha256()
+        for url in self.payload_urls():
+            # always a fresh download - never a payload left pending by an
+            # earlier call
+            payload = download(url)
+            self._pending_payloads()[url] = payload
+            digest.update(payload)
+        return digest.hexdigest()
+
+    def _pending_payloads(self) -> Dict[str, bytes]:
+        # not an attr.ib, as that would force all subclass attributes to have
+        # defaults
+        return self.__dict__.setdefault('_payloads', {})
+
+    def discard_payloads(self) -> None:
+        self._pending_payloads().clear()
+
+    def fetch(self, url: str) -> bytes:
+        '''Returns the raw bytes at url
+
+        See FIXTURE_MODE_ENV_VAR for recording / replaying these.
+        '''
+        payload = self._pending_payloads().pop(url, None)
+        if payload is None:
+            payload = download(url)
+        return payload
+
+    def read_csv(self, url: str, **kwargs) -> pandas.DataFrame:
+        return pandas.read_csv(io.BytesIO(self.fetch(url)), **kwargs)
+
+    def retrieve_shared(self, consumer: Any, consumers: typing.Set[Any],
+                        fingerprint: Optional[str]) \
+            -> Tuple[Optional[str], Optional[pandas.DataFrame]]:
+        '''Returns (fingerprint, data) for the latest upstream data - data is
+        None if the fingerprint is the one given (ie, nothing has changed)
+
+        One retriever serves several cache items (one per data type), so they
+        share the work: one lock covers the fingerprint, pending payloads and
+        retrieve, and a check made within the last UPDATE_INTERVAL is reused
+        rather than downloading again.  Retrieved data is held until each of
+        consumers (the items' data types) has had it, or the next check.
+        '''
+        with self._retrieval_lock():
+            latest = self.__dict__.get('_latest_retrieval')
+            now = datetime.datetime.utcnow()
+            if latest is None or now - latest.check_time > UPDATE_INTERVAL:
+                latest = Retrieval(check_time=now,
+                                   fingerprint=self.fingerprint(),
+                                   waiting=set(consumers))
+                self.__dict__['_latest_retrieval'] = latest
+            latest.waiting.discard(consumer)
+            try:
+                if latest.fingerprint is not None \
+                        and latest.fingerprint == fingerprint:
+                    return fingerprint, None
+                data = latest.data
+                if data is None:
+                    # uses the payloads fingerprint() downloaded, if they're
+                    # still pending
+                    data = latest.data = self.retrieve()
+                return latest.fingerprint, data
+            finally:
+                # don't hold payloads (ie, if retrieve() failed, or nobody
+                # needed it), or data nobody else is waiting for
+                self.discard_payloads()
+                if not latest.waiting:
+                    latest.data = None
+
+    def _retrieval_lock(self) -> threading.RLock:
+        # not an attr.ib, for the same reason as _pending_payloads
+        return self.__dict__.setdefault('_retrieval_lock', threading.RLock())
+
+
+@attr.s(auto_attribs=True)
+class Retrieval(object):
+    '''One check of a retriever's upstream data, shared by it's cache items'''
+    check_time: datetime.datetime
+    fingerprint: Optional[str]
+    # the consumers that haven't had the data yet
+    waiting: typing.Set[Any]
+    # only held while some are waiting for it
+    data: Optional[pandas.DataFrame] = None
+
+
+# Set to "record" to save every payload downloaded by DataRetriever.fetch to
+# the directory in FIXTURE_DIR_ENV_VAR, or "replay" to read them from there
+# instead of downloading - ie, for load tests (see loadtest.py) against fixed,
+# local data
+FIXTURE_MODE_ENV_VAR = 'COVID19_FIXTURE_MODE'
+FIXTURE_DIR_ENV_VAR = 'COVID19_FIXTURE_DIR'
+
+
+def fixture_path(directory: str, url: str) -> str:
+    name = re.sub(r'\W+', '_', url.rsplit('/', 1)[-1]).strip('_')[-60:]
+    url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(directory, '{}_{}'.format(url_hash, name))
+
+
+def download(url: str) -> bytes:
+    mode = os.environ.get(FIXTURE_MODE_ENV_VAR)
+    if not mode:
+        with urllib.request.urlopen(url) as response:
+            return response.read()
+    if mode not in ('record', 'replay'):
+        raise ValueError('unknown {}: {!r} - must be record or replay'
+                         .format(FIXTURE_MODE_ENV_VAR, mode))
+    directory = os.environ.get(FIXTURE_DIR_ENV_VAR)
+    if not directory:
+        raise ValueError('{} must be set when {} is'.format(
+            FIXTURE_DIR_ENV_VAR, FIXTURE_MODE_ENV_VAR))
+    path = fixture_path(directory, url)
+    if mode == 'replay':
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise FileNotFoundError(
+                'no recorded fixture for {} (expected {})'.format(url, path))
+    with urllib.request.urlopen(url) as response:
+        payload = response.read()
+    os.makedirs(directory, exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(payload)
+    return payload
+
+
+def combine_fingerprints(*fingerprints: Optional[str]) -> Optional[str]:
+    if any(x is None for x in fingerprints):
+        return None
+    return hashlib.sha256('\n'.join(fingerprints).encode('utf-8')).hexdigest()
+
+
+def dependency_fingerprint(item: 'DataCacheItem') -> str:
+    '''Fingerprint for a retriever input that comes from another cache item'''
+    item.refresh()
+    return '{!r}:{}'.format(item.key, item.version)
+
 
 UPDATE_INTERVAL = datetime.timedelta(hours=1)
 
 
+class RefreshNotifier(object):
+    '''Process-wide registry of listeners to call when a DataCacheItem's data
+    is replaced
+
+    Listeners are held weakly (bound methods via WeakMethod), so a forgotten
+    unsubscribe doesn't keep a dead session alive.
+    '''
+
+    def __init__(self):
+        self._listeners = {}
+        self._next_token = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._listeners)
+
+    def subscribe(self, callback: Callable[['DataCacheItem'], None]) -> int:
+        if inspect.ismethod(callback):
+            ref = weakref.WeakMethod(callback)
+        else:
+            ref = weakref.ref(callback)
+        with self._lock:
+            token = self._next_token
+            self._next_token += 1
+            self._listeners[token] = ref
+        return token
+
+    def unsubscribe(self, token: int) -> None:
+        with self._lock:
+            self._listeners.pop(token, None)
+
+    def notify(self, item: 'DataCacheItem') -> None:
+        with self._lock:
+            listeners = list(self._listeners.items())
+        for token, ref in listeners:
+            callback = ref()
+            if callback is None:
+                self.unsubscribe(token)
+            else:
+                callback(item)
+
+
+refresh_notifier = RefreshNotifier()
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class DataCacheMetadata(object):
+    '''Small summary of a DataCacheItem's data, recorded at each refresh
+
+    Lets things like the Info tab or health checks report on an item without
+    loading (or holding onto) the full frame.
+    '''
+    update_time: datetime.datetime
+    fetch_seconds: float
+    num_rows: int
+    num_entities: Optional[int]
+    size_bytes: int
+    max_date: Optional[pandas.Timestamp]
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        result = attr.asdict(self)
+        result['update_time'] = self.update_time.isoformat()
+        if self.max_date is not None:
+            result['max_date'] = self.max_date.isoformat()
+        return result
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class DateEntityMatrix(object):
+    '''One column of a DataCacheItem as a dense 2-D array, with a row per date
+    and a column per entity (NaN where an entity has no value on a date)
+    '''
+    dates: pandas.DatetimeIndex
+    entity_ids: pandas.Index
+    values: numpy.ndarray
+
+    def row(self, date: Optional[pandas.Timestamp] = None) -> pandas.Series:
+        '''Returns every entity's value on the given date, indexed by entity id
+
+        Uses the latest date on or before the one given (or the latest date
+        overall, if none is given); the series' name is the date actually used.
+        '''
+        i = self._date_position(date)
+        if i < 0:
+            return pandas.Series(numpy.nan, index=self.entity_ids, name=None)
+        return pandas.Series(self.values[i], index=self.entity_ids,
+                             name=self.dates[i])
+
+    def daily_row(self, window: int,
+                  date: Optional[pandas.Timestamp] = None) -> pandas.Series:
+        '''Like row, but each value is the day-to-day change, averaged over
+        the past window days (as main.daily_rolling_average)
+
+        NaN for entities without a value at both ends of the window.
+        '''
+        i = self._date_position(date)
+        if i < 0:
+            return pandas.Series(numpy.nan, index=self.entity_ids, name=None)
+        back = max(i - window, 0)
+        count = min(i + 1, window)
+        return pandas.Series((self.values[i] - self.values[back]) / count,
+                             index=self.entity_ids, name=self.dates[i])
+
+    def _date_position(self, date: Optional[pandas.Timestamp]) -> int:
+        if date is None:
+            return len(self.dates) - 1
+        return self.dates.searchsorted(pandas.Timestamp(date),
+                                       side='right') - 1
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class LoadedData(object):
+    '''Everything a DataCacheItem holds for one version of it's data
+
+    A refresh makes a whole new one, and swaps it in with a single assignment -
+    so readers (which may be in other threads) take the item's current one
+    once, and never see the storage from one refresh with the indexes from
+    another.
+    '''
+    storage: storage.FrameStorage
+    # one row per entity, indexed by entity id; columns are the entity's
+    # fields, the start / stop rows of that entity's data, the maximum over
+    # the entity's rows of each numeric column (so filters over an entity's
+    # whole history don't need to read it), and any per-entity columns from
+    # the retriever's entity_joins.  None if the data isn't per-entity.
+    entity_index: Optional[pandas.DataFrame] = None
+    entity_slices: Dict[int, slice] = attr.Factory(dict)
+    # indexed like entity_index - the latest non-null value of each numeric
+    # column, for each entity
+    latest_values: Optional[pandas.DataFrame] = None
+    # caches of results made from this data, filled in as they're asked for
+    # {(column, per_million, daily_window): sorted latest values} - see
+    # DataCacheItem.ranking
+    rankings: Dict[Tuple[str, bool, Optional[int]], pandas.Series] = \
+        attr.Factory(dict)
+    # {column: DateEntityMatrix} - see DataCacheItem.date_matrix
+    matrices: Dict[str, DateEntityMatrix] = attr.Factory(dict)
+
+
 @attr.s(auto_attribs=True)
 class DataCacheItem(object):
     retriever: DataRetriever
+    key: Optional[DataCacheKey] = None
+    # used to create the storage for per-entity data
+    storage_factory: storage.StorageFactory = storage.memory_storage_factory
+    # when the data last changed
     update_time: Optional[datetime.datetime] = attr.ib(default=None, init=False)
-    _data: Optional[pandas.DataFrame] = attr.ib(default=None, init=False)
+    # when we last checked upstream for new data
+    check_time: Optional[datetime.datetime] = attr.ib(default=None, init=False)
+    # incremented every time the data is replaced, so derived results can be
+    # cached against it
+    version: int = attr.ib(default=0, init=False)
+    metadata: Optional[DataCacheMetadata] = attr.ib(default=None, init=False)
+    # None until loaded
+    _data: Optional[LoadedData] = attr.ib(default=None, init=False)
+    _fingerprint: Optional[str] = attr.ib(default=None, init=False)
+    # datasets are made in worker threads (see main.dataset_executor), so make
+    # sure only one of them fetches at a time
+    _refresh_lock: Any = attr.ib(
+        default=attr.Factory(threading.RLock), init=False, repr=False,
+        eq=False)
+    # all the items (including this one) that share our retriever - see
+    # DataRetriever.retrieve_shared
+    _siblings: List['DataCacheItem'] = attr.ib(
+        default=attr.Factory(list), init=False, repr=False, eq=False)
+
+    def entity_type(self) -> Optional[Type[entities.Entity]]:
+        if self.key is None:
+            return None
+        entity = self.key.entity_data_type.entity
+        if inspect.isclass(entity):
+            return entity
+        return type(entity)
+
+    def is_loaded(self) -> bool:
+        return self._data is not None
+
+    def is_stale(self) -> bool:
+        if self._data is None:
+            return True
+        return (datetime.datetime.utcnow() - self.check_time) > UPDATE_INTERVAL
+
+    def refresh(self) -> None:
+        if not self.is_stale():
+            return
+        with self._refresh_lock:
+            # another thread may have refreshed while we waited
+            if self.is_stale():
+                self._refresh()
+
+    def _refresh(self) -> None:
+        start = time.perf_counter()
+        # the retrieved data is kept for the siblings that will be refreshed
+        # too - those not loaded yet may never be, so aren't waited for
+        consumer = None if self.key is None else self.key.entity_data_type
+        consumers = {x.key.entity_data_type for x in self._siblings
+                     if x.key is not None and x.is_loaded()}
+        consumers.add(consumer)
+        fingerprint, data = self.retriever.retrieve_shared(
+            consumer, consumers,
+            self._fingerprint if self.is_loaded() else None)
+        if data is None:
+            # upstream payload is byte-for-byte the same - keep the existing
+            # data (and version), so nothing derived from it is invalidated
+            self.check_time = datetime.datetime.utcnow()
+            return
+        data, loaded = self._load(data)
+        self._fingerprint = fingerprint
+        self.update_time = self.check_time = datetime.datetime.utcnow()
+        # the new data goes in before the version changes, so anything that
+        # reads the version and then the data never gets older data than the
+        # version says
+        self._data = loaded
+        self.version += 1
+        self._update_metadata(data, loaded, time.perf_counter() - start)
+        refresh_notifier.notify(self)
+
+    def _loaded(self) -> LoadedData:
+        '''Refreshes if need be, and returns the current LoadedData - which
+        readers should only get once per call'''
+        self.refresh()
+        return self._data
 
     def get(self) -> pandas.DataFrame:
-        now = datetime.datetime.utcnow()
-        if self._data is None or (now - self.update_time) > UPDATE_INTERVAL:
-            self._data = self.retriever.retrieve()
-            self.update_time = now
-        return self._data
+        return self._loaded().storage.read()
+
+    def _load(self, data: pandas.DataFrame) \
+            -> Tuple[pandas.DataFrame, LoadedData]:
+        '''Returns the processed data, and the LoadedData holding it - which
+        isn't swapped in here'''
+        entity_type = self.entity_type()
+        if entity_type is None \
+                or not set(entity_type._fields).issubset(data.columns):
+            # not per-entity data (ie, raw population tables) - these are
+            # small, and read whole, so always keep them in memory
+            frame_storage = storage.MemoryStorage()
+            frame_storage.write(data)
+            return data, LoadedData(frame_storage)
+
+        # Tag each row with it's interned entity id, and sort so that each
+        # entity's rows are contiguous (and in date order)
+        data = data.assign(
+            entity_id=entities.registry.frame_ids(entity_type, data))
+        sort_columns = ['entity_id']
+        if 'date' in data.columns:
+            sort_columns.append('date')
+        data = data.sort_values(sort_columns, kind='mergesort')
+        data = data.reset_index(drop=True)
+
+        ids = data.entity_id.values
+        if len(ids):
+            starts = numpy.flatnonzero(numpy.r_[True, ids[1:] != ids[:-1]])
+        else:
+            starts = numpy.array([], dtype=int)
+        stops = numpy.r_[starts[1:], len(ids)].astype(int)
+        index_columns = {field: data[field].values[starts]
+                         for field in entity_type._fields}
+        index_columns['start'] = starts
+        index_columns['stop'] = stops
+        latest_columns = {}
+        if len(ids):
+            row_numbers = numpy.arange(len(ids))
+            for name in data.columns:
+                column = data[name]
+                if name in index_columns or name == 'entity_id' \
+                        or not pandas.api.types.is_numeric_dtype(column) \
+                        or pandas.api.types.is_bool_dtype(column):
+                    continue
+                # fmax ignores NaNs
+                index_columns[name] = numpy.fmax.reduceat(column.values,
+                                                          starts)
+                # the last non-null row of each entity, or -1 if none
+                last = numpy.maximum.reduceat(
+                    numpy.where(column.notna().values, row_numbers, -1),
+                    starts)
+                latest = column.values.take(numpy.maximum(last, 0))
+                latest = latest.astype(float)
+                latest[last < 0] = numpy.nan
+                latest_columns[name] = latest
+        entity_ids = pandas.Index(ids[starts], name='entity_id')
+        entity_index = pandas.DataFrame(index_columns, index=entity_ids)
+        latest_values = pandas.DataFrame(latest_columns, index=entity_ids)
+        for join, lookup_item in self.retriever.entity_joins():
+            entity_index = join.apply(entity_index, lookup_item.get())
+        entity_slices = {
+            entity_id: slice(start, stop)
+            for entity_id, start, stop in zip(ids[starts].tolist(),
+                                              starts.tolist(), stops.tolist())
+        }
+        frame_storage = self.storage_factory(repr(self.key))
+        frame_storage.write(data)
+        return data, LoadedData(frame_storage, entity_index=entity_index,
+                                entity_slices=entity_slices,
+                                latest_values=latest_values)
+
+    def _update_metadata(self, data: pandas.DataFrame, loaded: LoadedData,
+                         fetch_seconds: float) -> None:
+        max_date = None
+        if 'date' in data.columns and len(data):
+            max_date = data.date.max()
+        num_entities = None
+        if loaded.entity_index is not None:
+            num_entities = len(loaded.entity_index)
+        self.metadata = DataCacheMetadata(
+            update_time=self.update_time,
+            fetch_seconds=fetch_seconds,
+            num_rows=len(data),
+            num_entities=num_entities,
+            # shallow - deep=True would scan every string in the frame, on
+            # every refresh
+            size_bytes=int(data.memory_usage(deep=False).sum()),
+            max_date=max_date,
+        )
+
+    def entity_index(self) -> Optional[pandas.DataFrame]:
+        '''Returns a frame with one row per entity, indexed by entity id
+
+        Returns None if this item's data isn't keyed by entity.
+        '''
+        return self._loaded().entity_index
+
+    def frame_storage(self) -> Optional[storage.FrameStorage]:
+        '''The storage holding the processed frame - None until loaded'''
+        loaded = self._data
+        return None if loaded is None else loaded.storage
+
+    def derived_data(self) -> Dict[str, Any]:
+        '''Returns the structures derived from the frame (indexes, rankings,
+        etc), by name - ie, for memory accounting'''
+        loaded = self._data
+        if loaded is None:
+            return {}
+        return {
+            'entity_index': loaded.entity_index,
+            'entity_slices': loaded.entity_slices,
+            'latest_values': loaded.latest_values,
+            'rankings': loaded.rankings,
+            'matrices': loaded.matrices,
+        }
+
+    def entity_value(self, entity: entities.Entity, column: str) -> Any:
+        '''Returns a per-entity value (ie, population) from the entity index'''
+        index = self.entity_index()
+        try:
+            return index.at[entity.id, column]
+        except KeyError:
+            return numpy.nan
+
+    def ranking(self, column: str, per_million: bool = False,
+                daily_window: Optional[int] = None) -> pandas.Series:
+        '''Returns each entity's latest value of column, highest first
+
+        If daily_window is given, each entity's value is instead it's latest
+        day-to-day change in column, averaged over that many days (as
+        main.daily_rolling_average does for graphing).
+
+        Indexed by entity id; entities with no value are left out.  Computed
+        (and sorted) once per refresh, so it's cheap to call repeatedly.
+        '''
+        loaded = self._loaded()
+        key = (column, per_million, daily_window)
+        ranking = loaded.rankings.get(key)
+        if ranking is not None:
+            return ranking
+        if daily_window is not None:
+            latest = self._latest_daily(loaded, column, daily_window)
+        elif loaded.latest_values is not None \
+                and column in loaded.latest_values.columns:
+            latest = loaded.latest_values[column]
+        else:
+            latest = None
+        if latest is None:
+            ranking = pandas.Series([], dtype=float)
+        else:
+            ranking = latest
+            if per_million:
+                if 'population' in loaded.entity_index.columns:
+                    ranking = ranking / (loaded.entity_index.population / 1e6)
+                else:
+                    ranking = ranking * numpy.nan
+            ranking = ranking.dropna().sort_values(ascending=False,
+                                                   kind='mergesort')
+        # cached with the data it was made from, so a refresh meanwhile can't
+        # leave it cached against newer data
+        loaded.rankings[key] = ranking
+        return ranking
+
+    @staticmethod
+    def _latest_daily(loaded: LoadedData, column: str,
+                      window: int) -> Optional[pandas.Series]:
+        if loaded.entity_index is None \
+                or column not in loaded.storage.columns():
+            return None
+        data = loaded.storage.read(columns=['entity_id', column])
+        # like make_dataset, averages are over the non-null rows
+        data = data[data[column].notna().values]
+        ids = data.entity_id.values
+        values = data[column].values.astype(float)
+        if not len(ids):
+            return pandas.Series([], dtype=float)
+        # rows are grouped by entity, and in date order
+        starts = numpy.flatnonzero(numpy.r_[True, ids[1:] != ids[:-1]])
+        lasts = numpy.r_[starts[1:], len(ids)] - 1
+        # values are running totals, so each average is one subtraction
+        backs = numpy.maximum(lasts - window, starts)
+        counts = numpy.minimum(lasts - starts + 1, window)
+        return pandas.Series((values[lasts] - values[backs]) / counts,
+                             index=pandas.Index(ids[starts], name='entity_id'))
+
+    def date_matrix(self, column: str) -> Optional[DateEntityMatrix]:
+        '''Returns column as a dense date x entity matrix
+
+        Made on first request, and kept until the next refresh - so every
+        entity's value on one date is a single row read.  Returns None if this
+        item doesn't have dated, per-entity data with that column.
+        '''
+        loaded = self._loaded()
+        matrix = loaded.matrices.get(column)
+        if matrix is not None:
+            return matrix
+        if loaded.entity_index is None:
+            return None
+        stored_columns = loaded.storage.columns()
+        if 'date' not in stored_columns or column not in stored_columns:
+            return None
+        data = loaded.storage.read(columns=['entity_id', 'date', column])
+        date_rows, dates = pandas.factorize(data.date, sort=True)
+        entity_ids = loaded.entity_index.index
+        entity_columns = entity_ids.get_indexer(data.entity_id.values)
+        # entity_joins may have dropped some entities from the index - leave
+        # their rows out, rather than letting -1 write them to the last column
+        indexed = entity_columns >= 0
+        values = numpy.full((len(dates), len(entity_ids)), numpy.nan)
+        values[date_rows[indexed], entity_columns[indexed]] = \
+            data[column].values[indexed]
+        matrix = DateEntityMatrix(pandas.DatetimeIndex(dates), entity_ids,
+                                  values)
+        loaded.matrices[column] = matrix
+        return matrix
+
+    def entity_data(self, entity: entities.Entity,
+                    start_date: Optional[pandas.Timestamp] = None,
+                    warmup: int = 0,
+                    column: Optional[str] = None,
+                    columns: Optional[List[str]] = None) -> pandas.DataFrame:
+        '''Returns just the rows for the given entity, sorted by date
+
+        See FrameStorage.read_entity for start_date / warmup / column /
+        columns - only asking for the columns needed means, with column
+        storage, the others are never loaded.
+        '''
+        loaded = self._loaded()
+        if loaded.entity_index is None:
+            data = entity.filter_dataframe(loaded.storage.read())
+            if columns is not None:
+                data = data[[x for x in data.columns if x in columns]]
+            return data
+        entity_id = entity.id
+        rows = loaded.entity_slices.get(entity_id, slice(0, 0))
+        return loaded.storage.read_entity(entity_id, rows,
+                                         start_date=start_date, warmup=warmup,
+                                         column=column, columns=columns)
 
     def max_date(self) -> Optional[pandas._libs.tslibs.timestamps.Timestamp]:
         '''Convenience method for querying the maximum date in the data'''
-        data = self.get()
-        if 'date' in data.columns:
-            return data.date.max()
-        return None
+        self.refresh()
+        return self.metadata.max_date
 
 
 @attr.s(auto_attribs=True)
 class DataCache(object):
+    storage_factory: storage.StorageFactory = storage.memory_storage_factory
     _cache: typing.Dict[str, DataCacheItem] = \
         attr.ib(init=False, default=attr.Factory(dict))
 
@@ -128,19 +745,39 @@ class DataCache(object):
     def keys(self) -> typing.Iterable[DataCacheKey]:
         return self._cache.keys()
 
+    def items(self) -> typing.Iterable[Tuple[DataCacheKey, DataCacheItem]]:
+        return self._cache.items()
+
     def values(self) -> typing.Iterable[DataCacheItem]:
         return self._cache.values()
 
     def add(self, retriever: DataRetriever) -> None:
         source_id = retriever.source().id
+        siblings = []
         for data_type in retriever.data_types():
             key = DataCacheKey(data_type, source_id)
-            self._cache[key] = DataCacheItem(retriever)
+            item = DataCacheItem(retriever, key, self.storage_factory)
+            item._siblings = siblings
+            siblings.append(item)
+            self._cache[key] = item
 
     def get(self, *key: DataCacheKeyTuple) -> pandas.DataFrame:
         '''Convenience accessor for just the data at a given key'''
         return self[DataCacheKey.create(key)].get()
 
+    def refresh_stale(self) -> List[DataCacheItem]:
+        '''Re-fetches any previously loaded items that have gone stale
+
+        Items nobody has asked for yet are left alone.  Returns the items that
+        were refreshed; listeners on refresh_notifier are told about each.
+        '''
+        refreshed = []
+        for item in self.values():
+            if item.is_loaded() and item.is_stale():
+                item.refresh()
+                refreshed.append(item)
+        return refreshed
+
 
 @attr.s(auto_attribs=True)
 class FileCachedRetriever(DataRetriever):
@@ -160,6 +797,15 @@ class FileCachedRetriever(DataRetriever):
         # otherwise, assume that cwd is the repo root!
         return pathlib.Path('.') / self.filename
 
+    def fingerprint(self) -> Optional[str]:
+        local_path = self.local_path()
+        if local_path.is_file():
+            return hashlib.sha256(local_path.read_bytes()).hexdigest()
+        return self.remote_retriever.fingerprint()
+
+    def discard_payloads(self) -> None:
+        self.remote_retriever.discard_payloads()
+
     def retrieve(self) -> pandas.DataFrame:
         local_path = self.local_path()
         if local_path.is_file():
@@ -173,3 +819,140 @@ class FileCachedRetriever(DataRetriever):
         }
         data.to_csv(str(local_path), index=False, compression=compression_opts)
         return data
+
+
+################################################################################
+# Pipeline stages
+
+@enum.unique
+class JoinValidation(enum.Enum):
+    # no checks
+    none = 'none'
+    # every key in the lookup table must be present in the data (the data may
+    # have extra keys, which are dropped)
+    subset = 'subset'
+    # every key in the data must be present in the lookup table (the lookup
+    # table may have extra keys)
+    covered = 'covered'
+    # the data and the lookup table must have exactly the same keys
+    exact = 'exact'
+
+
+# a column name, or a function that returns the keys for a frame
+JoinKey = Union[str, Callable[[pandas.DataFrame], Any]]
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class IndexedJoin(object):
+    '''Inner-joins columns from a lookup table onto a frame, by key
+
+    Rather than a full pandas.merge, each row's key is looked up in an index of
+    the lookup table's keys (Index.get_indexer), and the new columns are
+    gathered with a single vectorized take.
+    '''
+    left_on: JoinKey
+    columns: List[str]
+    # if None, use the lookup table's index
+    right_on: Optional[JoinKey] = None
+    validation: JoinValidation = JoinValidation.none
+
+    @staticmethod
+    def _keys(frame: pandas.DataFrame, key: JoinKey) -> pandas.Index:
+        if callable(key):
+            return pandas.Index(key(frame))
+        return pandas.Index(frame[key])
+
+    def validate(self, data_keys: pandas.Index,
+                 lookup_keys: pandas.Index) -> None:
+        if self.validation == JoinValidation.none:
+            return
+        data_keys = data_keys.unique()
+        if self.validation != JoinValidation.covered:
+            missing = lookup_keys.difference(data_keys)
+            if len(missing):
+                raise ValueError('{} keys in lookup table not found in data -'
+                                 ' ie: {}'.format(len(missing),
+                                                  list(missing[:5])))
+        if self.validation != JoinValidation.subset:
+            extra = data_keys.difference(lookup_keys)
+            if len(extra):
+                raise ValueError('{} keys in data not found in lookup table -'
+                                 ' ie: {}'.format(len(extra), list(extra[:5])))
+
+    def _match(self, data: pandas.DataFrame, lookup: pandas.DataFrame):
+        '''Returns (lookup, positions, matched) - positions of each data row's
+        key in the (de-duplicated) lookup, and a mask of the rows that have one
+        '''
+        if self.right_on is None:
+            lookup_keys = lookup.index
+        else:
+            lookup_keys = self._keys(lookup, self.right_on)
+        if not lookup_keys.is_unique:
+            # unlike merge (which would repeat the data row once per match),
+            # the first duplicate key in the lookup table wins
+            first = ~lookup_keys.duplicated()
+            lookup = lookup[first]
+            lookup_keys = lookup_keys[first]
+        data_keys = self._keys(data, self.left_on)
+        self.validate(data_keys, lookup_keys)
+        positions = lookup_keys.get_indexer(data_keys)
+        return lookup, positions, positions >= 0
+
+    def restrict(self, data: pandas.DataFrame,
+                 lookup: pandas.DataFrame) -> pandas.DataFrame:
+        '''Validates, and drops rows without a match - but adds no columns
+
+        For when the columns will be joined later, per entity instead of per
+        row (see DataRetriever.entity_joins).
+        '''
+        _, _, matched = self._match(data, lookup)
+        if matched.all():
+            return data
+        return data[matched]
+
+    def apply(self, data: pandas.DataFrame,
+              lookup: pandas.DataFrame) -> pandas.DataFrame:
+        lookup, positions, matched = self._match(data, lookup)
+        columns = {name: data[name].values for name in data.columns}
+        index = data.index
+        if not matched.all():
+            columns = {name: values[matched]
+                       for name, values in columns.items()}
+            positions = positions[matched]
+            index = index[matched]
+        for name in self.columns:
+            columns[name] = lookup[name].values.take(positions)
+        return pandas.DataFrame(columns, index=index)
+
+
+def sum_rows(groups: numpy.ndarray, num_groups: int,
+             values: numpy.ndarray) -> numpy.ndarray:
+    '''Sums the rows of a 2-D array by group (ie, provinces into countries)
+
+    groups gives the group number (0 <= group < num_groups) of each row; missing
+    values are counted as 0.
+    '''
+    totals = numpy.zeros((num_groups,) + values.shape[1:])
+    numpy.add.at(totals, groups, numpy.nan_to_num(values))
+    return totals
+
+
+def wide_to_long(keys: pandas.DataFrame, dates: pandas.DatetimeIndex,
+                 **values: numpy.ndarray) -> pandas.DataFrame:
+    '''Lays out 2-D arrays - with a row per row of keys, and a column per date -
+    as a long frame, with one row per (key, date)
+
+    Rows come out grouped by key, and in date order within each key - which is
+    the order DataCacheItem sorts them into anyway.  Unlike DataFrame.melt, this
+    is just a few repeats / tiles of the arrays.
+    '''
+    num_keys, num_dates = len(keys), len(dates)
+    columns = {name: numpy.repeat(keys[name].values, num_dates)
+               for name in keys.columns}
+    columns['date'] = numpy.tile(dates.values, num_keys)
+    for name, array in values.items():
+        if array.shape != (num_keys, num_dates):
+            raise ValueError('{} has shape {} - expected {}'.format(
+                name, array.shape, (num_keys, num_dates)))
+        columns[name] = array.ravel()
+    return pandas.DataFrame(columns)
@@ -0,0 +1,85 @@
+'''Runs the bokeh app and the data api (see api.py) in a single server process
+
+Usage:
+    python -m covid19.server [--port PORT] [--show]
+'''
+
+import argparse
+import concurrent.futures
+import os
+import traceback
+
+import bokeh.application
+import bokeh.application.handlers
+import tornado.ioloop
+
+from bokeh.server.server import Server
+
+from . import api
+from . import datamod
+from . import main
+
+
+APP_PATH = '/covid19'
+
+# how often to check for stale data - open sessions are pushed any new data
+# via the retrievers.refresh_notifier
+REFRESH_CHECK_MS = 5 * 60 * 1000
+
+# refreshes download and process data, so they're run here, rather than on the
+# io loop, where they'd stall every session until done
+refresh_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='refresh_stale')
+
+
+def make_server(port=5006, **kwargs):
+    handler = bokeh.application.handlers.FunctionHandler(main.modify_doc)
+    app = bokeh.application.Application(handler)
+
+    # bokeh serve reads this from the environment, so we should too
+    origins = [x for x in os.environ.get('BOKEH_ALLOW_WS_ORIGIN', '').split(',')
+               if x]
+    if origins:
+        kwargs.setdefault('allow_websocket_origin', origins)
+
+    return Server({APP_PATH: app}, port=port,
+                  extra_patterns=api.url_patterns(APP_PATH), **kwargs)
+
+
+def start_refreshing():
+    '''Checks for stale data every REFRESH_CHECK_MS, in refresh_executor'''
+    refresh = None
+
+    def report_error(future):
+        error = future.exception()
+        if error is not None:
+            traceback.print_exception(type(error), error, error.__traceback__)
+
+    def check():
+        nonlocal refresh
+        if refresh is not None and not refresh.done():
+            # the last one is still going
+            return
+        refresh = refresh_executor.submit(datamod.data_cache.refresh_stale)
+        refresh.add_done_callback(report_error)
+
+    tornado.ioloop.PeriodicCallback(check, REFRESH_CHECK_MS).start()
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=5006)
+    parser.add_argument('--show', action='store_true',
+                        help='open the app in a browser once started')
+    args = parser.parse_args(argv)
+
+    server = make_server(port=args.port)
+    server.start()
+    start_refreshing()
+    if args.show:
+        server.io_loop.add_callback(server.show, APP_PATH)
+    server.io_loop.start()
+
+
+if __name__ == '__main__':
+    run()
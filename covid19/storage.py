@@ -0,0 +1,588 @@
+'''Storage backends for the processed, per-entity frames held by DataCacheItems
+
+The default keeps frames in memory; setting the environment variable
+COVID19_CACHE_STORAGE=sqlite instead writes them to a local SQLite database,
+indexed by (entity_id, date), so only the rows actually needed are read back.
+
+COVID19_CACHE_STORAGE=columns keeps each numeric (stat) column in it's own
+.npy file in COVID19_SPILL_DIR, only loading the ones that are actually asked
+for.
+
+In memory, the total size of the frames can be limited by setting
+COVID19_CACHE_MEMORY_BUDGET_MB - the least recently used frames (or, with
+columns storage, loaded columns) are then spilled to files in
+COVID19_SPILL_DIR, and reloaded when next needed.
+'''
+
+import abc
+import collections
+import itertools
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
+
+import numpy
+import pandas
+
+from typing import Callable, List, Optional
+
+
+STORAGE_ENV_VAR = 'COVID19_CACHE_STORAGE'
+SQLITE_PATH_ENV_VAR = 'COVID19_SQLITE_PATH'
+MEMORY_BUDGET_ENV_VAR = 'COVID19_CACHE_MEMORY_BUDGET_MB'
+SPILL_DIR_ENV_VAR = 'COVID19_SPILL_DIR'
+
+
+class FrameStorage(abc.ABC):
+    '''Holds one DataCacheItem's processed frame
+
+    Frames are written sorted by (entity_id, date), so each entity's rows are
+    contiguous; they can be read back either whole, or one entity at a time.
+    '''
+
+    @abc.abstractmethod
+    def write(self, data: pandas.DataFrame) -> None:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def read(self, columns: Optional[List[str]] = None) -> pandas.DataFrame:
+        '''Returns the whole frame - or just the given columns of it'''
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def read_entity(self, entity_id: int, rows: slice,
+                    start_date: Optional[pandas.Timestamp] = None,
+                    warmup: int = 0,
+                    column: Optional[str] = None,
+                    columns: Optional[List[str]] = None) -> pandas.DataFrame:
+        '''Returns the rows for one entity, sorted by date
+
+        rows is that entity's row range in the frame as last written.  If
+        start_date is given, rows before it are skipped - except for up to
+        warmup rows immediately before it (only counting rows where column is
+        not null, if given), for calculations that need some history, like
+        rolling averages.  If columns is given, only those columns are
+        returned.
+        '''
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def columns(self) -> List[str]:
+        raise NotImplementedError()
+
+    def memory_bytes(self) -> int:
+        '''How much memory the frame is taking up in this process'''
+        return 0
+
+
+def _select(data: pandas.DataFrame,
+            columns: Optional[List[str]]) -> pandas.DataFrame:
+    if columns is None:
+        return data
+    return data[[x for x in data.columns if x in columns]]
+
+
+def _window_start(dates: numpy.ndarray, values: Optional[numpy.ndarray],
+                  start_date: pandas.Timestamp, warmup: int) -> int:
+    '''Returns the index of the first of one entity's rows to read, for
+    FrameStorage.read_entity's start_date / warmup
+
+    values are that entity's values of the warmup column, if any.
+    '''
+    first = int(numpy.searchsorted(dates, numpy.datetime64(start_date)))
+    if warmup and first:
+        if values is not None:
+            valid = numpy.flatnonzero(pandas.notna(values[:first]))
+            first = int(valid[-warmup]) if len(valid) >= warmup else 0
+        else:
+            first = max(0, first - warmup)
+    return first
+
+
+class MemoryStorage(FrameStorage):
+    '''Keeps the frame in memory
+
+    If given a MemoryBudget, the frame may be spilled to spill_path when
+    other frames are used more recently, and is then reloaded on demand.
+    '''
+
+    def __init__(self, budget: Optional['MemoryBudget'] = None,
+                 spill_path: Optional[str] = None):
+        if budget is not None and spill_path is None:
+            raise ValueError('spill_path is required with a budget')
+        self.budget = budget
+        self.spill_path = spill_path
+        self._data = None
+        self._spilled = False
+        self._spilled_before = False
+        # whether the file at spill_path holds the current frame - frames
+        # aren't changed after write, so it only needs writing once per write
+        self._spill_current = False
+        self._columns = []
+        # deep memory_usage scans every string in the frame, so this is only
+        # worked out when asked for (see memory_bytes)
+        self._nbytes = None
+        self._lock = threading.Lock()
+
+    def _frame(self) -> pandas.DataFrame:
+        '''Returns the frame, reloading it if it was spilled'''
+        with self._lock:
+            data = self._data
+            if data is None and self._spilled:
+                start = time.perf_counter()
+                data = self._data = pandas.read_pickle(self.spill_path)
+                self._spilled = False
+                self.budget.record_reload(time.perf_counter() - start)
+        if self.budget is not None and data is not None:
+            self.budget.touch(self)
+        return data
+
+    def spill(self) -> None:
+        '''Writes the frame to spill_path, and drops it from memory'''
+        with self._lock:
+            if self._data is None:
+                return
+            if not self._spilled_before:
+                # clean up once this storage is no longer used
+                weakref.finalize(self, _remove_file, self.spill_path)
+                self._spilled_before = True
+            if not self._spill_current:
+                self._data.to_pickle(self.spill_path)
+                self._spill_current = True
+            self._data = None
+            self._spilled = True
+
+    def is_spilled(self) -> bool:
+        return self._spilled
+
+    def write(self, data: pandas.DataFrame) -> None:
+        with self._lock:
+            self._data = data
+            self._spilled = False
+            self._spill_current = False
+            self._columns = list(data.columns)
+            self._nbytes = None
+        if self.budget is not None:
+            self.budget.touch(self)
+
+    def read(self, columns: Optional[List[str]] = None) -> pandas.DataFrame:
+        return _select(self._frame(), columns)
+
+    def read_entity(self, entity_id: int, rows: slice,
+                    start_date: Optional[pandas.Timestamp] = None,
+                    warmup: int = 0,
+                    column: Optional[str] = None,
+                    columns: Optional[List[str]] = None) -> pandas.DataFrame:
+        del entity_id
+        data = self._frame()
+        start = rows.start
+        if start_date is not None and rows.stop > rows.start:
+            values = None
+            if column is not None and column in data.columns:
+                values = data[column].values[rows]
+            start += _window_start(data.date.values[rows], values,
+                                   start_date, warmup)
+        data = _select(data, columns)
+        return data.iloc[start:rows.stop].reset_index(drop=True)
+
+    def columns(self) -> List[str]:
+        # without reloading the frame, if it's spilled
+        return list(self._columns)
+
+    def memory_bytes(self) -> int:
+        data = self._data
+        if data is None:
+            return 0
+        if self._nbytes is None:
+            self._nbytes = int(data.memory_usage(deep=True).sum())
+        return self._nbytes
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class ColumnStorage(FrameStorage):
+    '''Keeps each numeric column in it's own .npy file in directory, and only
+    loads it when it's first asked for
+
+    The other columns (entity_id, date, entity names, etc) are always kept in
+    memory.  With a MemoryBudget, loaded columns may be dropped again (spill
+    does nothing else - they're already on disk).
+    '''
+
+    def __init__(self, directory: str,
+                 budget: Optional['MemoryBudget'] = None):
+        self.directory = directory
+        self.budget = budget
+        self._columns = []
+        self._base = None
+        self._base_nbytes = 0
+        # {column name: path} for the numeric columns
+        self._paths = {}
+        # {column name: values} for those that are loaded
+        self._loaded = {}
+        # columns dropped by spill - loading one again is a reload
+        self._evicted = set()
+        self._lock = threading.Lock()
+        weakref.finalize(self, shutil.rmtree, directory, ignore_errors=True)
+
+    def write(self, data: pandas.DataFrame) -> None:
+        lazy = [name for name in data.columns
+                if name not in ('entity_id', 'date')
+                and pandas.api.types.is_numeric_dtype(data[name])
+                and not pandas.api.types.is_bool_dtype(data[name])]
+        os.makedirs(self.directory, exist_ok=True)
+        paths = {}
+        for i, name in enumerate(lazy):
+            # the index keeps names unique, ie "a:b" vs "a_b"
+            path = os.path.join(self.directory,
+                                '{}_{}.npy'.format(i, table_name(name)))
+            numpy.save(path, data[name].values, allow_pickle=False)
+            paths[name] = path
+        base = data.drop(columns=lazy)
+        with self._lock:
+            self._columns = list(data.columns)
+            self._base = base
+            self._base_nbytes = int(base.memory_usage(deep=True).sum())
+            self._paths = paths
+            self._loaded = {}
+            self._evicted = set()
+
+    def _values(self, name: str) -> numpy.ndarray:
+        if name not in self._paths:
+            return self._base[name].values
+        with self._lock:
+            values = self._loaded.get(name)
+            if values is None:
+                start = time.perf_counter()
+                values = self._loaded[name] = numpy.load(self._paths[name])
+                # the first load of each column isn't a reload
+                if self.budget is not None and name in self._evicted:
+                    self.budget.record_reload(time.perf_counter() - start)
+        if self.budget is not None:
+            self.budget.touch(self)
+        return values
+
+    def _frame(self, columns: Optional[List[str]],
+               rows: slice = slice(None)) -> pandas.DataFrame:
+        names = self._columns
+        if columns is not None:
+            names = [x for x in names if x in columns]
+        return pandas.DataFrame({name: self._values(name)[rows]
+                                 for name in names})
+
+    def read(self, columns: Optional[List[str]] = None) -> pandas.DataFrame:
+        return self._frame(columns)
+
+    def read_entity(self, entity_id: int, rows: slice,
+                    start_date: Optional[pandas.Timestamp] = None,
+                    warmup: int = 0,
+                    column: Optional[str] = None,
+                    columns: Optional[List[str]] = None) -> pandas.DataFrame:
+        del entity_id
+        start = rows.start
+        if start_date is not None and rows.stop > rows.start:
+            values = None
+            if column is not None and column in self._columns:
+                values = self._values(column)[rows]
+            start += _window_start(self._values('date')[rows], values,
+                                   start_date, warmup)
+        return self._frame(columns, slice(start, rows.stop))
+
+    def columns(self) -> List[str]:
+        return list(self._columns)
+
+    def loaded_columns(self) -> List[str]:
+        return list(self._loaded)
+
+    def spill(self) -> None:
+        '''Drops all the loaded numeric columns'''
+        with self._lock:
+            self._evicted.update(self._loaded)
+            self._loaded = {}
+
+    def is_spilled(self) -> bool:
+        return not self._loaded
+
+    def memory_bytes(self) -> int:
+        return self._base_nbytes + sum(x.nbytes
+                                       for x in list(self._loaded.values()))
+
+
+class MemoryBudget(object):
+    '''Keeps the total size of a set of storages under max_bytes, by spilling
+    the least recently used ones to disk
+
+    The storages need spill and memory_bytes methods - ie, MemoryStorage and
+    ColumnStorage.
+    '''
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self.reloads = 0
+        self.reload_seconds = 0.0
+        self.max_reload_seconds = 0.0
+        # {id(storage): weakref to storage}, least recently used first - weak,
+        # so storages replaced by a refresh aren't kept alive
+        self._resident = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _live(self) -> List[FrameStorage]:
+        live = []
+        for key, ref in list(self._resident.items()):
+            storage = ref()
+            if storage is None:
+                del self._resident[key]
+            else:
+                live.append(storage)
+        return live
+
+    def touch(self, storage: FrameStorage) -> None:
+        '''Marks storage as just used, evicting others if over budget'''
+        with self._lock:
+            self._resident[id(storage)] = weakref.ref(storage)
+            self._resident.move_to_end(id(storage))
+            resident = self._live()
+            total = sum(x.memory_bytes() for x in resident)
+            to_spill = []
+            # never evict the one being used - even if it alone is too big
+            for lru in resident[:-1]:
+                if total <= self.max_bytes:
+                    break
+                del self._resident[id(lru)]
+                total -= lru.memory_bytes()
+                to_spill.append(lru)
+            self.evictions += len(to_spill)
+        for lru in to_spill:
+            lru.spill()
+
+    def record_reload(self, seconds: float) -> None:
+        with self._lock:
+            self.reloads += 1
+            self.reload_seconds += seconds
+            self.max_reload_seconds = max(self.max_reload_seconds, seconds)
+
+    def stats(self) -> dict:
+        with self._lock:
+            resident = self._live()
+            return {
+                'max_bytes': self.max_bytes,
+                'resident_bytes': sum(x.memory_bytes() for x in resident),
+                'num_resident': len(resident),
+                'evictions': self.evictions,
+                'reloads': self.reloads,
+                'mean_reload_seconds': (self.reload_seconds / self.reloads
+                                        if self.reloads else None),
+                'max_reload_seconds': self.max_reload_seconds,
+            }
+
+
+class SqliteStorage(FrameStorage):
+    '''Keeps the frame in a SQLite table, indexed on (entity_id, date)
+
+    Dates are stored as integer nanoseconds, so they compare (and round-trip)
+    exactly.  The table is dropped (and the connection closed) by close, or
+    once this storage is no longer used - a refresh writes a new storage, and
+    table, while readers may still be using this one.
+    '''
+
+    def __init__(self, path: str, table: str):
+        self.path = path
+        self.table = table
+        self._columns = []
+        self._date_columns = []
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._finalizer = weakref.finalize(self, _drop_table,
+                                           self._connection, table)
+
+    def _connect(self) -> sqlite3.Connection:
+        return self._connection
+
+    def close(self) -> None:
+        '''Drops the table, and closes the connection'''
+        with self._lock:
+            self._finalizer()
+
+    def _from_sql(self, data: pandas.DataFrame) -> pandas.DataFrame:
+        for name in self._date_columns:
+            if name in data.columns:
+                data[name] = pandas.to_datetime(data[name], unit='ns')
+        return data[[x for x in self._columns if x in data.columns]]
+
+    def _select_sql(self, columns: Optional[List[str]]) -> str:
+        if columns is None:
+            return '*'
+        return ', '.join('"{}"'.format(x) for x in self._columns
+                         if x in columns)
+
+    def write(self, data: pandas.DataFrame) -> None:
+        self._columns = list(data.columns)
+        self._date_columns = [
+            name for name in data.columns
+            if pandas.api.types.is_datetime64_any_dtype(data[name])]
+        data = data.assign(**{name: data[name].values.astype('int64')
+                              for name in self._date_columns})
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('DROP TABLE IF EXISTS "{}"'
+                                   .format(self.table))
+                data.to_sql(self.table, connection, index=False)
+                if 'entity_id' in data.columns:
+                    index_columns = ['entity_id']
+                    if 'date' in data.columns:
+                        index_columns.append('date')
+                    connection.execute(
+                        'CREATE INDEX "{0}_entity" ON "{0}" ({1})'.format(
+                            self.table, ', '.join(index_columns)))
+
+    def _query(self, sql, params=()) -> pandas.DataFrame:
+        with self._lock:
+            data = pandas.read_sql_query(sql, self._connect(), params=params)
+        return self._from_sql(data)
+
+    def read(self, columns: Optional[List[str]] = None) -> pandas.DataFrame:
+        order = ''
+        if 'entity_id' in self._columns:
+            order = ' ORDER BY entity_id'
+            if 'date' in self._columns:
+                order += ', date'
+        return self._query('SELECT {} FROM "{}"{}'.format(
+            self._select_sql(columns), self.table, order))
+
+    def read_entity(self, entity_id: int, rows: slice,
+                    start_date: Optional[pandas.Timestamp] = None,
+                    warmup: int = 0,
+                    column: Optional[str] = None,
+                    columns: Optional[List[str]] = None) -> pandas.DataFrame:
+        del rows
+        sql = 'SELECT {} FROM "{}" WHERE entity_id = ?'.format(
+            self._select_sql(columns), self.table)
+        params = [entity_id]
+        if start_date is not None:
+            start_ns = pandas.Timestamp(start_date).value
+            if warmup:
+                not_null = ''
+                if column is not None and column in self._columns:
+                    not_null = ' AND "{}" IS NOT NULL'.format(column)
+                with self._lock:
+                    warmup_start = self._connect().execute(
+                        'SELECT date FROM "{}" WHERE entity_id = ? AND date < ?'
+                        '{} ORDER BY date DESC LIMIT 1 OFFSET ?'
+                        .format(self.table, not_null),
+                        (entity_id, start_ns, warmup - 1)).fetchone()
+                # if there aren't enough rows before start_date, use them all
+                start_ns = None if warmup_start is None else warmup_start[0]
+            if start_ns is not None:
+                sql += ' AND date >= ?'
+                params.append(start_ns)
+        if 'date' in self._columns:
+            sql += ' ORDER BY date'
+        return self._query(sql, params)
+
+    def columns(self) -> List[str]:
+        return list(self._columns)
+
+
+def _drop_table(connection: sqlite3.Connection, table: str) -> None:
+    try:
+        with connection:
+            connection.execute('DROP TABLE IF EXISTS "{}"'.format(table))
+    except sqlite3.Error:
+        pass
+    finally:
+        connection.close()
+
+
+StorageFactory = Callable[[str], FrameStorage]
+
+
+def table_name(name: str) -> str:
+    return re.sub(r'\W+', '_', name).strip('_')
+
+
+def memory_storage_factory(name: str) -> FrameStorage:
+    del name
+    return MemoryStorage()
+
+
+class BudgetedMemoryStorageFactory(object):
+    '''Makes MemoryStorages that share one MemoryBudget'''
+
+    def __init__(self, budget: MemoryBudget, spill_dir: str):
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self._counter = itertools.count()
+
+    def __call__(self, name: str) -> FrameStorage:
+        os.makedirs(self.spill_dir, exist_ok=True)
+        # unique per storage, as a refresh makes a new one for the same name
+        path = os.path.join(self.spill_dir, '{}_{}.pkl'.format(
+            table_name(name), next(self._counter)))
+        return MemoryStorage(budget=self.budget, spill_path=path)
+
+
+class SqliteStorageFactory(object):
+    '''Makes SqliteStorages, each with it's own table in the database at
+    path'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._counter = itertools.count()
+
+    def __call__(self, name: str) -> FrameStorage:
+        # unique per storage, as a refresh makes a new one for the same name,
+        # while the old one's table may still be being read
+        table = '{}_{}'.format(table_name(name), next(self._counter))
+        return SqliteStorage(self.path, table)
+
+
+class ColumnStorageFactory(object):
+    '''Makes ColumnStorages, each in it's own subdirectory of spill_dir'''
+
+    def __init__(self, spill_dir: str, budget: Optional[MemoryBudget] = None):
+        self.spill_dir = spill_dir
+        self.budget = budget
+        self._counter = itertools.count()
+
+    def __call__(self, name: str) -> FrameStorage:
+        # unique per storage, as a refresh makes a new one for the same name
+        directory = os.path.join(self.spill_dir, '{}_{}'.format(
+            table_name(name), next(self._counter)))
+        return ColumnStorage(directory, budget=self.budget)
+
+
+def storage_factory_from_environment() -> StorageFactory:
+    kind = os.environ.get(STORAGE_ENV_VAR, 'memory')
+    budget = None
+    budget_mb = os.environ.get(MEMORY_BUDGET_ENV_VAR)
+    if budget_mb:
+        budget = MemoryBudget(int(float(budget_mb) * 2 ** 20))
+    # per process, for the same reason as the sqlite database, below
+    spill_dir = os.environ.get(SPILL_DIR_ENV_VAR) or os.path.join(
+        tempfile.gettempdir(), 'covid19_spill_{}'.format(os.getpid()))
+    if kind == 'memory':
+        if budget is None:
+            return memory_storage_factory
+        return BudgetedMemoryStorageFactory(budget, spill_dir)
+    elif kind == 'columns':
+        return ColumnStorageFactory(spill_dir, budget)
+    elif kind == 'sqlite':
+        # one database per process, since every process refreshes
+        # (and rewrites) it's own tables
+        path = os.environ.get(SQLITE_PATH_ENV_VAR) or os.path.join(
+            tempfile.gettempdir(), 'covid19_cache_{}.sqlite'.format(os.getpid()))
+        return SqliteStorageFactory(path)
+    raise ValueError('unknown {}: {!r} - must be memory, columns or sqlite'
+                     .format(STORAGE_ENV_VAR, kind))
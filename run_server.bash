@@ -1,4 +1,4 @@
 #!/bin/bash
 source /usr/local/anaconda3/etc/profile.d/conda.sh
 conda activate covid19graphs
-bokeh serve --show covid19 --port 80
\ No newline at end of file
+python -m covid19.server --show --port 80